@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, F
+
+
+def populate_unread_messages(apps, schema_editor):
+    User = apps.get_model('accounts', 'TimtecUser')
+    if User._meta.swapped:
+        return
+    ProfessorMessage = apps.get_model('core', 'ProfessorMessage')
+    ProfessorMessageRead = apps.get_model('core', 'ProfessorMessageRead')
+    users_field = ProfessorMessage._meta.get_field('users')
+    user_field = users_field.m2m_reverse_field_name()
+
+    received = users_field.rel.through.objects.order_by() \
+        .values_list(user_field) \
+        .annotate(Count('id'))
+    read = dict(ProfessorMessageRead.objects
+                .filter(is_read=True, message__users=F('user'))
+                .order_by()
+                .values_list('user')
+                .annotate(Count('id')))
+    for user_id, count in received.iterator():
+        unread = count - read.get(user_id, 0)
+        if unread:
+            User.objects.filter(id=user_id).update(unread_messages=unread)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_auto_20180203_0020'),
+        ('core', '0032_professormessagedelivery_started_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timtecuser',
+            name='unread_messages',
+            field=models.IntegerField(default=0, verbose_name='Unread messages', editable=False),
+        ),
+        migrations.RunPython(populate_unread_messages, migrations.RunPython.noop),
+    ]
@@ -5,12 +5,14 @@ from django.utils.translation import ugettext_lazy as _
 from django.core import validators
 from django.core.mail import send_mail
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, UserManager, Group
 from django.utils import timezone
 
-from core.utils import hash_name
+from core.utils import hash_name, skip_counter_fields
 from easy_thumbnails.files import get_thumbnailer
 from easy_thumbnails.exceptions import InvalidImageFormatError
+import hashlib
 import re
 
 
@@ -36,6 +38,9 @@ class AbstractTimtecUser(AbstractBaseUser, PermissionsMixin):
     site = models.URLField(_('Site'), blank=True)
     biography = models.TextField(_('Biography'), blank=True)
     accepted_terms = models.BooleanField(_('Accepted terms and condition'), default=False)
+    # Denormalized count of unread professor messages, kept up to date by
+    # the ProfessorMessage and ProfessorMessageRead signals in core.models.
+    unread_messages = models.IntegerField(_('Unread messages'), default=0, editable=False)
 
     objects = UserManager()
 
@@ -61,10 +66,19 @@ class AbstractTimtecUser(AbstractBaseUser, PermissionsMixin):
 
     def get_picture_thumb_url(self,
                               options={'size': (150, 150), 'crop': 'scale'}):
-        try:
-            return get_thumbnailer(self.picture).get_thumbnail(options).url
-        except InvalidImageFormatError as e:
+        if not self.picture:
             return str(settings.STATIC_URL + 'img/avatar-default.png')
+        # uploaded pictures get a new name, so the name identifies the thumbnail
+        key = 'picture-thumb-' + hashlib.md5(
+            (self.picture.name + repr(sorted(options.items()))).encode('utf-8')).hexdigest()
+        url = cache.get(key)
+        if url is None:
+            try:
+                url = get_thumbnailer(self.picture).get_thumbnail(options).url
+            except InvalidImageFormatError as e:
+                url = str(settings.STATIC_URL + 'img/avatar-default.png')
+            cache.set(key, url, settings.PICTURE_THUMB_CACHE_TIMEOUT)
+        return url
 
     def get_full_name(self):
         full_name = '%s %s' % (self.first_name, self.last_name)
@@ -108,6 +122,9 @@ class AbstractTimtecUser(AbstractBaseUser, PermissionsMixin):
     def save(self, *args, **kwargs):
 
         is_new = self.pk is None
+        if not is_new:
+            # only the message signals write the counter of existing users
+            kwargs = skip_counter_fields(self, ('unread_messages',), kwargs)
 
         super(AbstractTimtecUser, self).save(*args, **kwargs)
 
@@ -16,7 +16,7 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from core.models import Course, CourseProfessor
+from core.models import Course, get_course_roles
 from core.permissions import IsAdmin
 from activities.models import Activity
 from course_material.models import File as TimtecFile
@@ -53,7 +53,7 @@ class AdminView(AdminMixin, TemplateView, views._access.AccessMixin):
         response = super(AdminView, self).dispatch(
             request, *args, **kwargs)
 
-        if not (request.user.is_superuser or CourseProfessor.objects.filter(user=request.user, role='coordinator').exists()):
+        if not (request.user.is_superuser or 'coordinator' in get_course_roles(request.user).values()):
             if self.raise_exception:  # *and* if an exception was desired
                 raise PermissionDenied  # return a forbidden response.
 
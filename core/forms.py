@@ -6,7 +6,7 @@ from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.db.models import Q
 
-from .models import Class, CourseStudent
+from .models import Class
 import logging
 
 logger = logging.getLogger(__name__)
@@ -60,25 +60,19 @@ class AddStudentsForm(forms.ModelForm):
 
     def save(self, commit=True):
         User = get_user_model()
-        students = self.cleaned_data['students_text']
-
-        for student_name in students:
-            try:
-                student = User.objects.get(
-                    Q(username=student_name) |
-                    Q(email=student_name)
-                )
-                self.instance.add_students(student)
-
-                if self.data.get('auto_enroll', False) == "True":
-                    # Check if the new user is already enrolled
-                    try:
-                        CourseStudent.objects.get(user=student, course=self.instance.course)
-                    except CourseStudent.DoesNotExist:
-                        CourseStudent.objects.create(user=student, course=self.instance.course)
-                        pass
-
-            except User.DoesNotExist:
+        names = self.cleaned_data['students_text']
+
+        # resolve every username or e-mail in a single query
+        students = list(User.objects.filter(Q(username__in=names) | Q(email__in=names)))
+        found = set(s.username for s in students) | set(s.email for s in students)
+        for student_name in names:
+            if student_name not in found:
                 logger.info(u'student with username: %s does not exist' % student_name)
 
+        self.instance.add_students(*students)
+
+        if self.data.get('auto_enroll', False) == "True":
+            # users already enrolled are skipped
+            self.instance.course.bulk_enroll(s.id for s in students)
+
         return super(AddStudentsForm, self).save(commit=commit)
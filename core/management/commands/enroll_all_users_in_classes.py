@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
 from django.db import transaction
-from core.models import Class, CourseStudent
+from core.models import Course
 
 
 class Command(BaseCommand):
@@ -10,18 +11,16 @@ class Command(BaseCommand):
 
     @transaction.atomic
     def handle(self, *args, **options):
+        User = get_user_model()
 
-        # List all classes
-        classes = Class.objects.all()
+        enrolled = 0
+        for course in Course.objects.all():
+            # students of the course classes without a CourseStudent, in one anti-join
+            missing = User.objects.filter(classes__course=course) \
+                .exclude(coursestudent__course=course) \
+                .order_by() \
+                .values_list('id', flat=True) \
+                .distinct()
+            enrolled += course.bulk_enroll(missing)
 
-        # Iterate classes
-        for one_class in classes:
-            # Iterate students in class
-            for student in one_class.students.all():
-                # Check if student has CourseStudent relationship for the given course_material
-                try:
-                    CourseStudent.objects.get(user=student, course=one_class.course)
-                except CourseStudent.DoesNotExist:
-                    # If there is none, create it
-                    CourseStudent.objects.create(user=student, course=one_class.course)
-                    pass
+        self.stdout.write('%d students enrolled' % enrolled)
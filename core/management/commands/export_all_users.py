@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+from __future__ import division
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 
 import csv
+import gzip
+import sys
+import time
 
 User = get_user_model()
 
@@ -11,23 +15,71 @@ def get_model_fields(model):
     return model._meta.fields
 
 
+def iter_users(chunk_size):
+    """Yields every user ordered by id, loading chunk_size users at a time."""
+    last_id = 0
+    while True:
+        chunk = list(User.objects.filter(id__gt=last_id).order_by('id')
+                     .prefetch_related('groups')[:chunk_size])
+        if not chunk:
+            return
+        for user in chunk:
+            yield user
+        last_id = chunk[-1].id
+
+
 class Command(BaseCommand):
-    args = ''
     help = 'Export all users data to a CSV file'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='users_data.csv',
+                            help='Path of the CSV file, or - for stdout')
+        parser.add_argument('--gzip', action='store_true', default=False,
+                            help='Compress the output with gzip')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='How many users are loaded at once')
+
     def handle(self, *args, **options):
-        with open('users_data.csv', 'wb') as csvfile:
-            writer = csv.writer(csvfile)
-            fields = get_model_fields(User)
-            writer.writerow(fields)
-
-            for obj in User.objects.all():
-                row = []
-                for field in fields:
-                    try:
-                        row.append(str(getattr(obj, field.name).encode('utf-8')))
-                    except Exception as e:
-                        row.append(str(getattr(obj, field.name)))
-                # Get user groups
-                row.append(obj.groups.all())
-                writer.writerow(row)
+        if options['output'] == '-':
+            output = sys.stdout
+        else:
+            output = open(options['output'], 'wb')
+        csvfile = gzip.GzipFile(fileobj=output, mode='wb') if options['gzip'] else output
+
+        try:
+            exported = self.export(csvfile, options['chunk_size'])
+        finally:
+            if csvfile is not output:
+                csvfile.close()
+            if output is not sys.stdout:
+                output.close()
+
+        self.stderr.write('%d users exported' % exported)
+
+    def export(self, csvfile, chunk_size):
+        writer = csv.writer(csvfile)
+        fields = get_model_fields(User)
+        writer.writerow([field.name for field in fields] + ['groups'])
+
+        start = time.time()
+        count = 0
+        for obj in iter_users(chunk_size):
+            row = []
+            for field in fields:
+                try:
+                    row.append(str(getattr(obj, field.name).encode('utf-8')))
+                except Exception as e:
+                    row.append(str(getattr(obj, field.name)))
+            # Get user groups
+            row.append(u','.join(group.name for group in obj.groups.all()).encode('utf-8'))
+            writer.writerow(row)
+
+            count += 1
+            if count % chunk_size == 0:
+                elapsed = time.time() - start
+                self.stderr.write('%d users exported (%.0f users/s)' % (count, count / elapsed))
+
+        elapsed = time.time() - start
+        if elapsed:
+            self.stderr.write('Exported in %.1fs (%.0f users/s)' % (elapsed, count / elapsed))
+        return count
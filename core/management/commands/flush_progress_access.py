@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from core.progress_buffer import CacheAccessBuffer, get_access_buffer
+
+
+class Command(BaseCommand):
+    help = 'Write the buffered StudentProgress.last_access updates to the database'
+
+    def handle(self, *args, **options):
+        access_buffer = get_access_buffer()
+        if not isinstance(access_buffer, CacheAccessBuffer):
+            raise CommandError("Only the 'cache' STUDENT_PROGRESS_WRITE_BEHIND buffer "
+                               "can be flushed from outside the web processes")
+
+        flushed = access_buffer.flush()
+        self.stdout.write('%d accesses flushed' % flushed)
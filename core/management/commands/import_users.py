@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
+from __future__ import division
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth import get_user_model, models
+from django.contrib.auth.hashers import make_password
 from django.db import transaction
 
+from itertools import islice
+from multiprocessing import Pool
+import time
 import unicodecsv
 
 User = get_user_model()
@@ -14,30 +19,94 @@ sizes = {
 }
 
 
+def truncate(row):
+    for fieldname, size in sizes.items():
+        if fieldname in row:
+            row[fieldname] = row[fieldname][:size]
+    return row
+
+
 class Command(BaseCommand):
     args = 'file'
     help = 'import users'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--bulk', action='store_true', default=False,
+                            help='Insert the users in batches, hashing passwords in parallel')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many users each bulk insert creates')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes hashing passwords (defaults to the number of CPUs)')
+
     @transaction.atomic
     def handle(self, *files, **options):
 
         if not len(files) == 1:
             raise CommandError('No file to import')
 
+        start = time.time()
         with open(files[0], 'r') as csvfile:
             readf = unicodecsv.DictReader(csvfile)
-            count = 0
-            for row in readf:
-                for fieldname, size in sizes.items():
-                    if fieldname in row:
-                        row[fieldname] = row[fieldname][:size]
-                set_password = row.pop('set_password')
-                nu = User.objects.create(**row)
-                nu.set_password(set_password)
-                nu.is_if_staff = True
-                nu.save()
-                if nu.cpf:  # only valid for IfUsers, remove if you don't need it
-                    nu.groups.add(models.Group.objects.get(name="professors"))
-                count += 1
-                if count % 10 == 0:
-                    print '.',
+            if options['bulk']:
+                count = self.bulk_import(readf, options['batch_size'], options['workers'])
+            else:
+                count = self.import_rows(readf)
+
+        elapsed = time.time() - start
+        if elapsed:
+            self.stdout.write('%d users imported (%.0f rows/s)' % (count, count / elapsed))
+
+    def import_rows(self, readf):
+        count = 0
+        for row in readf:
+            truncate(row)
+            set_password = row.pop('set_password')
+            nu = User.objects.create(**row)
+            nu.set_password(set_password)
+            nu.is_if_staff = True
+            nu.save()
+            if nu.cpf:  # only valid for IfUsers, remove if you don't need it
+                nu.groups.add(models.Group.objects.get(name="professors"))
+            count += 1
+            if count % 10 == 0:
+                print '.',
+        return count
+
+    def bulk_import(self, readf, batch_size, workers):
+        Membership = User.groups.through
+        user_column = User.groups.field.m2m_column_name()
+        group_column = User.groups.field.m2m_reverse_name()
+        professors = None
+        pool = Pool(workers)
+        count = 0
+        try:
+            while True:
+                rows = [truncate(row) for row in islice(readf, batch_size)]
+                if not rows:
+                    break
+                passwords = pool.map(make_password, [row.pop('set_password') for row in rows])
+
+                users = []
+                for row, password in zip(rows, passwords):
+                    user = User(**row)
+                    user.password = password
+                    user.is_if_staff = True
+                    users.append(user)
+                User.objects.bulk_create(users)
+
+                # only valid for IfUsers, remove if you don't need it
+                usernames = [user.username for user in users if getattr(user, 'cpf', None)]
+                if usernames:
+                    if professors is None:
+                        professors = models.Group.objects.get(name="professors")
+                    Membership.objects.bulk_create([
+                        Membership(**{user_column: user_id, group_column: professors.id})
+                        for user_id in User.objects.filter(username__in=usernames)
+                                                   .values_list('id', flat=True)])
+
+                count += len(users)
+                self.stdout.write('%d users imported' % count)
+        finally:
+            pool.close()
+            pool.join()
+        return count
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from core.models import Course
+from core.progress import rebuild_progress_counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored progress counters of every course enrollment'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_slugs', nargs='*',
+                            help='Only rebuild the given courses')
+
+    def handle(self, *args, **options):
+        courses = Course.objects.all()
+        if options['course_slugs']:
+            courses = courses.filter(slug__in=options['course_slugs'])
+
+        changed = rebuild_progress_counters(courses)
+        self.stdout.write('%d enrollments updated' % changed)
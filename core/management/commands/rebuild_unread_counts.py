@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from core.models import ProfessorMessage
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored unread professor messages counter of every user'
+
+    def handle(self, *args, **options):
+        changed = ProfessorMessage.rebuild_unread_counts()
+        self.stdout.write('%d users updated' % changed)
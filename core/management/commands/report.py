@@ -4,9 +4,13 @@ from __future__ import division
 import csv
 import cStringIO
 import codecs
+from itertools import islice
+from multiprocessing import Pool
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
+from django.db import connections
 from core.models import Course, CourseStudent
+from core.progress import LessonProgressCalculator
 
 
 User = get_user_model()
@@ -41,73 +45,106 @@ class DictUnicodeWriter(object):
         self.writer.writeheader()
 
 
+def read_batches(emails_file, batch_size):
+    """Yields lists of up to batch_size e-mails, reading the file lazily."""
+    emails = (line.strip() for line in emails_file)
+    emails = (email for email in emails if email)
+    while True:
+        batch = list(islice(emails, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+_calculator = None
+
+
+def init_worker(course_id):
+    global _calculator
+    _calculator = LessonProgressCalculator(Course.objects.get(id=course_id))
+
+
+def report_batch(emails):
+    """
+    Returns the report rows of a batch of e-mails and how many of them are
+    enrolled in the course, with a fixed number of queries per batch.
+    """
+    course = _calculator.course
+    users = dict((user.email, user) for user in User.objects.filter(email__in=emails))
+    enrolled = set(CourseStudent.objects
+                   .filter(course=course, user__in=[user.id for user in users.values()])
+                   .values_list('user', flat=True))
+    progress = _calculator.for_users(enrolled)
+
+    rows = []
+    for email in emails:
+        user = users.get(email)
+        if user is None:
+            rows.append({'user_name': u'', 'email': email, 'name': u'', 'slug': u'',
+                         'progress': u'Não se inscreveu na plataforma', 'finish': u''})
+        elif user.id not in enrolled:
+            rows.append({'user_name': user.get_full_name(), 'email': user.email,
+                         'name': u'', 'slug': u'',
+                         'progress': u'Não começou o curso', 'finish': u''})
+        else:
+            for lesson in progress[user.id]:
+                finish = lesson['finish']
+                if finish:
+                    finish = finish.strftime('%d/%m/%Y - %H:%M')
+                rows.append({'user_name': user.get_full_name(), 'email': user.email,
+                             'name': lesson['name'], 'slug': lesson['slug'],
+                             'progress': unicode(lesson['progress']), 'finish': finish})
+    return rows, len(enrolled)
+
+
 class Command(BaseCommand):
-    args = 'course_slug output_file user_emails'
-    help = 'Help'
+    help = 'Write the lessons progress of the students with the given e-mails to csv files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_slug')
+        parser.add_argument('output_file')
+        parser.add_argument('emails_file', help='File with one e-mail per line')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='How many e-mails are resolved at once')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes computing the batches')
 
     def handle(self, *args, **options):
-        lessons_progress = []
-        avg_length = 0
-
-        emails_file = open(args[2])
-        course = Course.objects.get(slug=args[0])
-
-        for email in emails_file.readlines():
-            email = email[:-1]
-            try:
-                user = User.objects.get(email=email)
-                course_student = CourseStudent.objects.filter(user=user, course=course).first()
-                if course_student:
-                    updated_profile = user.first_name or user.last_name or user.picture or user.occupation or user.city or user.site or user.biography
-                    avg_length += 1
-                    for progress in course_student.percent_progress_by_lesson():
-                        progress['user_name'] = user.first_name + u'' + user.last_name
-                        progress['email'] = user.email
-                        progress['progress'] = str(progress['progress'])
-                        if progress['finish']:
-                            progress['finish'] = progress['finish'].strftime('%d/%m/%Y - %H:%M')
-                        progress['updated_profile'] = updated_profile
-                        lessons_progress.append(progress)
-                else:
-                    fake_progress = {}
-                    fake_progress['user_name'] = user.first_name + user.last_name
-                    fake_progress['email'] = user.email
-                    fake_progress['name'] = u''
-                    fake_progress['slug'] = u''
-                    fake_progress['progress'] = u'Não começou o curso'
-                    fake_progress['finish'] = u''
-                    lessons_progress.append(fake_progress)
-
-            except User.DoesNotExist:
-                fake_progress = {}
-                fake_progress['user_name'] = ''
-                fake_progress['email'] = email
-                fake_progress['name'] = u''
-                fake_progress['slug'] = u''
-                fake_progress['progress'] = u'Não se inscreveu na plataforma'
-                fake_progress['finish'] = u''
-                lessons_progress.append(fake_progress)
-
-        with open(args[1], 'wb') as output_file:
-            writer = DictUnicodeWriter(output_file, fieldnames=['name', 'slug', 'progress', 'finish', 'user_name', 'email'], delimiter=';', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            writer.writeheader()
-            writer.writerows(lessons_progress)
-
-        lessons_progress_avg = {}
-        for progress in lessons_progress:
-            try:
-                progress_float = float(progress['progress'])
-                if progress['slug'] in lessons_progress_avg.keys():
-                    lessons_progress_avg[progress['slug']] += progress_float
-                else:
-                    lessons_progress_avg[progress['slug']] = progress_float
-            except ValueError:
-                pass
+        course = Course.objects.get(slug=options['course_slug'])
+
+        with open(options['emails_file']) as emails_file:
+            batches = read_batches(emails_file, options['batch_size'])
+            if options['workers'] > 1:
+                # each worker process must open its own connection
+                connections.close_all()
+                pool = Pool(options['workers'], init_worker, (course.id,))
+                results = pool.imap(report_batch, batches)
+            else:
+                pool = None
+                init_worker(course.id)
+                results = (report_batch(batch) for batch in batches)
+
+            progress_sum = {}
+            avg_length = 0
+            with open(options['output_file'], 'wb') as output_file:
+                writer = DictUnicodeWriter(output_file, fieldnames=['name', 'slug', 'progress', 'finish', 'user_name', 'email'], delimiter=';', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+                writer.writeheader()
+                for rows, enrolled in results:
+                    writer.writerows(rows)
+                    avg_length += enrolled
+                    for row in rows:
+                        if row['slug']:
+                            progress_sum[row['slug']] = progress_sum.get(row['slug'], 0) + float(row['progress'])
+
+            if pool is not None:
+                pool.close()
+                pool.join()
+
         lessons_progress_avg_list = []
-        for key, value in lessons_progress_avg.items():
+        for key, value in progress_sum.items():
             lessons_progress_avg_list.append({'lesson': key, 'progress': str(value / avg_length)})
 
-        with open('lessons' + args[1], 'wb') as output_file:
+        with open('lessons' + options['output_file'], 'wb') as output_file:
             writer = DictUnicodeWriter(output_file, fieldnames=['lesson', 'progress'], delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
             writer.writeheader()
             writer.writerows(lessons_progress_avg_list)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from core.models import ProfessorMessageDelivery
+
+
+class Command(BaseCommand):
+    help = 'Deliver the professor messages waiting in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true', default=False,
+                            help='Also retry the deliveries that failed before, and the ones '
+                                 'left sending for longer than --sending-timeout')
+        parser.add_argument('--sending-timeout', type=int, default=60,
+                            help='Minutes after which a delivery still sending is considered '
+                                 'abandoned by a killed worker')
+
+    def handle(self, *args, **options):
+        claimable = Q(status='pending')
+        if options['retry_failed']:
+            stale = timezone.now() - timedelta(minutes=options['sending_timeout'])
+            claimable |= Q(status='failed')
+            claimable |= Q(status='sending') & (Q(started_date__lt=stale) | Q(started_date=None))
+
+        sent = failed = 0
+        pending = ProfessorMessageDelivery.objects.filter(claimable) \
+            .order_by('id').values_list('id', flat=True)
+        for pk in list(pending):
+            # claim the delivery, so concurrent workers never send it twice
+            claimed = ProfessorMessageDelivery.objects \
+                .filter(claimable, id=pk) \
+                .update(status='sending', started_date=timezone.now())
+            if not claimed:
+                continue
+            delivery = ProfessorMessageDelivery.objects.select_related('message').get(id=pk)
+            if delivery.deliver():
+                sent += 1
+            else:
+                failed += 1
+                self.stderr.write('Delivery %d failed: %s' % (pk, delivery.error))
+
+        self.stdout.write('%d messages sent, %d failed' % (sent, failed))
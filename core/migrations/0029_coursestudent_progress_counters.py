@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_progress_counters(apps, schema_editor):
+    CourseStudent = apps.get_model('core', 'CourseStudent')
+    StudentProgress = apps.get_model('core', 'StudentProgress')
+    Unit = apps.get_model('core', 'Unit')
+
+    totals = dict(Unit.objects.order_by()
+                  .values_list('lesson__course')
+                  .annotate(Count('id')))
+    for course_id, total in totals.items():
+        CourseStudent.objects.filter(course=course_id).update(total_units=total)
+
+    completed = StudentProgress.objects.exclude(complete=None).order_by() \
+        .values_list('user', 'unit__lesson__course') \
+        .annotate(Count('id'))
+    for user_id, course_id, done in completed.iterator():
+        CourseStudent.objects.filter(user=user_id, course=course_id) \
+            .update(completed_units=done)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_auto_20171226_1217'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coursestudent',
+            name='completed_units',
+            field=models.IntegerField(default=0, verbose_name='Completed units', editable=False),
+        ),
+        migrations.AddField(
+            model_name='coursestudent',
+            name='total_units',
+            field=models.IntegerField(default=0, verbose_name='Total units', editable=False),
+        ),
+        migrations.RunPython(populate_progress_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_coursestudent_progress_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfessorMessageDelivery',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('status', models.CharField(default=b'pending', max_length=16, verbose_name='Status', choices=[(b'pending', 'Pending'), (b'sending', 'Sending'), (b'sent', 'Sent'), (b'failed', 'Failed')])),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('sent_date', models.DateTimeField(null=True, verbose_name='Sent', blank=True)),
+                ('last_recipient', models.IntegerField(default=0, editable=False)),
+                ('recipients_sent', models.IntegerField(default=0, verbose_name='Recipients sent')),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(verbose_name='Error', blank=True)),
+                ('message', models.ForeignKey(related_name='deliveries', verbose_name='ProfessorMessage', to='core.ProfessorMessage')),
+            ],
+            options={
+                'verbose_name': 'Message delivery',
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_professormessagedelivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='outline_changed',
+            field=models.DateTimeField(verbose_name='Outline changed', null=True, editable=False),
+        ),
+    ]
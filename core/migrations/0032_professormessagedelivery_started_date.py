@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_course_outline_changed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='professormessagedelivery',
+            name='started_date',
+            field=models.DateTimeField(null=True, verbose_name='Started', blank=True),
+        ),
+    ]
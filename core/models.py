@@ -3,13 +3,15 @@ from __future__ import division
 
 import datetime
 
-from django.db import models
-from django.db.models.signals import m2m_changed
-from django.db.models import Count
-from django.core.mail import EmailMessage
+from django.db import connections, models, router, transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
+from django.db.models import Count, F
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.template import Template, Context
@@ -20,9 +22,12 @@ from autoslug import AutoSlugField
 from notes.models import Note
 from activities.models import Activity, Answer
 from course_material.models import CourseMaterial
-from .utils import hash_name
+from .utils import hash_name, skip_counter_fields, supports_upsert
 
 import re
+import smtplib
+import socket
+import traceback
 
 
 class Video(models.Model):
@@ -65,13 +70,12 @@ class Class(models.Model):
         return reverse('class', kwargs={'pk': self.id})
 
     def add_students(self, *objs):
-        for obj in objs:
-            try:
-                c = Class.objects.get(course=self.course, students=obj)
-                c.students.remove(obj)
-            except Class.DoesNotExist:
-                pass
-            self.students.add(obj)
+        """
+        Add the students (users or ids) to this class. remove_duplicate_classes
+        takes them out of the other classes of the course.
+        """
+        if objs:
+            self.students.add(*objs)
 
     def remove_students(self, *objs):
         for obj in objs:
@@ -87,23 +91,27 @@ class Class(models.Model):
 
 def remove_duplicate_classes(sender, instance, action, reverse, model, pk_set, **kwargs):
     """Clean the same student in twice classes."""
+    # only changes made through Class.students are handled
+    if reverse:
+        return
+    class_field = Class.students.field.m2m_field_name()
+    user_field = Class.students.field.m2m_reverse_field_name()
+
     # add student to default_class everytime that m2m cleans
     if action == 'pre_clear':
         default_class = instance.course.default_class
-        for student in instance.students.all():
-            student.classes.add(default_class)
+        students = set(instance.students.values_list('id', flat=True))
+        students -= set(default_class.students.values_list('id', flat=True))
+        sender.objects.bulk_create([sender(**{class_field: default_class,
+                                              user_field + '_id': student_id})
+                                    for student_id in students])
 
     # garantee that student has been subscribe in only one class
-    if action == 'post_add':
-        try:
-            for student in instance.students.all():
-                classes = student.classes.filter(course=instance.course).exclude(id=instance.id)
-                for classe in classes:
-                    student.classes.remove(classe)
-
-        # garantee that this block executes only when instance == Class.
-        except AttributeError:
-            pass
+    if action == 'post_add' and pk_set:
+        sender.objects.filter(**{class_field + '__course': instance.course_id,
+                                 user_field + '__in': pk_set}) \
+            .exclude(**{class_field: instance}) \
+            .delete()
 
 
 m2m_changed.connect(remove_duplicate_classes, sender=Class.students.through)
@@ -141,6 +149,8 @@ class Course(models.Model):
     min_percent_to_complete = models.IntegerField(default=100,
                                                   null=True,
                                                   blank=True)
+    # versions the cached CourseOutline, see invalidate_course_outline
+    outline_changed = models.DateTimeField(_('Outline changed'), null=True, editable=False)
 
     groups = models.ManyToManyField(
         Group,
@@ -176,6 +186,52 @@ class Course(models.Model):
         if not CourseStudent.objects.filter(course=self, user=student).exists():
             CourseStudent.objects.create(course=self, user=student)
 
+    def bulk_enroll(self, user_ids, chunk_size=1000):
+        """
+        Enroll many users with bulk inserts, chunk_size users at a time,
+        doing what CourseStudent.save does for each one: the progress
+        counters are initialised and a receipt is created. Users already
+        enrolled are skipped and class memberships are left untouched.
+
+        Returns the number of users enrolled.
+        """
+        from base64 import urlsafe_b64encode as ub64
+        from hashlib import sha1
+        from time import time
+
+        user_ids = list(user_ids)
+        total_units = self.unit_set.count()
+        enrolled = 0
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = set(user_ids[start:start + chunk_size])
+            chunk -= set(CourseStudent.objects.filter(course=self, user__in=chunk)
+                         .values_list('user', flat=True))
+            if not chunk:
+                continue
+            completed = dict(StudentProgress.objects.exclude(complete=None)
+                             .filter(user__in=chunk, unit__lesson__course=self)
+                             .order_by()
+                             .values_list('user')
+                             .annotate(Count('id')))
+            CourseStudent.objects.bulk_create([
+                CourseStudent(course=self, user_id=user_id, total_units=total_units,
+                              completed_units=completed.get(user_id, 0))
+                for user_id in chunk])
+
+            enrollments = CourseStudent.objects.filter(course=self, user__in=chunk) \
+                .values_list('id', 'user')
+            seed = str(time())
+            CourseCertification.objects.bulk_create([
+                CourseCertification(course_student_id=pk,
+                                    type=CourseCertification.TYPES[0][0],
+                                    is_valid=True,
+                                    course_workload=self.workload,
+                                    course_total_units=completed.get(user_id, 0),
+                                    link_hash=ub64(sha1('%s-%d-%d' % (seed, self.id, user_id)).digest()[0:6]))
+                for pk, user_id in enrollments])
+            enrolled += len(chunk)
+        return enrolled
+
     def is_enrolled(self, user):
         return CourseStudent.objects.filter(course=self, user=user).exists()
 
@@ -201,34 +257,53 @@ class Course(models.Model):
             return False
 
     def avg_lessons_users_progress(self, classes=None):
+        """
+        Average progress of the enrolled students in each lesson, optionally
+        limited to the students of the given classes. The result is cached
+        for settings.COURSE_STATS_CACHE_TIMEOUT seconds.
+        """
+        class_ids = None
         if classes:
-            student_enrolled = self.coursestudent_set.filter(
-                user__classes__in=classes).count()
-        else:
-            student_enrolled = self.coursestudent_set.all().count()
+            class_ids = sorted(set(c.id if isinstance(c, Class) else int(c) for c in classes))
+        cache_key = 'course-%d-lessons-progress-%s' % (
+            self.id, ','.join(str(c) for c in class_ids) if class_ids else 'all')
+        progress_list = cache.get(cache_key)
+        if progress_list is not None:
+            return progress_list
+
+        enrolled = self.coursestudent_set.all()
+        units_done = StudentProgress.objects.exclude(complete=None) \
+            .filter(unit__lesson__course=self)
+        if class_ids:
+            # a subquery instead of a join, so students with more than one
+            # class are not counted twice
+            students = get_user_model().objects.filter(classes__in=class_ids)
+            enrolled = enrolled.filter(user__in=students)
+            units_done = units_done.filter(user__in=students)
+        student_enrolled = enrolled.count()
+
+        done_by_lesson = dict(units_done.order_by()
+                              .values_list('unit__lesson')
+                              .annotate(Count('id')))
+
         progress_list = []
-        for lesson in self.lessons.all():
+        for lesson in self.lessons.values('id', 'name', 'slug', 'position') \
+                                  .annotate(units_count=Count('units')):
             lesson_progress = {}
-            lesson_progress['name'] = lesson.name
-            lesson_progress['slug'] = lesson.slug
-            lesson_progress['position'] = lesson.position
-            units_len = lesson.unit_count()
+            lesson_progress['name'] = lesson['name']
+            lesson_progress['slug'] = lesson['slug']
+            lesson_progress['position'] = lesson['position']
+            units_len = lesson['units_count']
             # avoid zero divisfion
             if units_len and student_enrolled:
-                units_done = StudentProgress.objects.exclude(
-                    complete=None).filter(unit__lesson=lesson)
-                if classes:
-                    units_done = units_done.filter(user__classes__in=classes)
-                units_done_len = units_done.count()
+                units_done_len = done_by_lesson.get(lesson['id'], 0)
                 lesson_progress['progress'] = 100 * units_done_len / (
                     units_len * student_enrolled)
-                # lesson_progress['forum_questions'] = lesson.forum_questions.count()
-                # lesson_progress['progress'] =
-                # lesson_progress['finish'] = self.get_lesson_finish_time(lesson)
             else:
                 lesson_progress['progress'] = 0
-                # lesson_progress['finish'] = ''
             progress_list.append(lesson_progress)
+
+        cache.set(cache_key, progress_list, settings.COURSE_STATS_CACHE_TIMEOUT)
         return progress_list
 
     def forum_answers_by_lesson(self):
@@ -248,11 +323,7 @@ class Course(models.Model):
         return professors_names
 
     def get_professor_role(self, user):
-        try:
-            cp = self.course_professors.get(user=user)
-            return cp.role
-        except CourseProfessor.DoesNotExist:
-            return False
+        return get_course_roles(user).get(self.id, False)
 
     def get_role_professors(self, role):
         try:
@@ -283,10 +354,12 @@ class Course(models.Model):
         role = self.get_professor_role(user)
         return role in ['assistant', 'coordinator'] or user.is_superuser
 
-    def is_course_coordinator(self, user):
-        course_coordinators = self.get_role_professors('coordinator')
+    def get_outline(self):
+        return CourseOutline.get(self.id)
 
-        return user.is_superuser or user.is_staff or user in course_coordinators
+    def is_course_coordinator(self, user):
+        return user.is_superuser or user.is_staff or \
+            self.get_professor_role(user) == 'coordinator'
 
     def has_perm_own_all_classes(self, user):
         role = self.get_professor_role(user)
@@ -308,6 +381,11 @@ class CourseStudent(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('Student'))
     course = models.ForeignKey(Course, verbose_name=_('Course'))
     start_date = models.DateTimeField(default=timezone.now)
+    # Denormalized progress counters, kept up to date by the StudentProgress
+    # and Unit signals below. Use the rebuild_progress_counters command to
+    # fix any drift.
+    completed_units = models.IntegerField(_('Completed units'), default=0, editable=False)
+    total_units = models.IntegerField(_('Total units'), default=0, editable=False)
 
     class Meta:
         unique_together = (('user', 'course'),)
@@ -317,6 +395,13 @@ class CourseStudent(models.Model):
         return u'{0} - {1}'.format(self.course, self.user)
 
     def save(self, *args, **kwargs):
+        if self.pk is None:
+            self.total_units = self.course.unit_set.count()
+            self.completed_units = self.units_done.count()
+        else:
+            # only the signals and rebuild_progress_counters write the counters
+            kwargs = skip_counter_fields(self, ('completed_units', 'total_units'), kwargs)
+
         super(CourseStudent, self).save(*args, **kwargs)
 
         try:
@@ -354,80 +439,51 @@ class CourseStudent(models.Model):
 
     @property
     def course_finished(self):
+        # ClassProgressCalculator computes this for whole classes at once
+        if hasattr(self, '_finished'):
+            return self._finished
         return self._plpc_course_finished()
 
     def can_emmit_receipt(self):
-        if not self.get_current_class().user_can_certificate and not self.course_finished:
+        current_class = self.get_current_class()
+        course_finished = self.course_finished
+        if not current_class.user_can_certificate and not course_finished:
             return False
-        if self.get_current_class().user_can_certificate_even_without_progress and self.certificate.type == 'certificate':
+        if current_class.user_can_certificate_even_without_progress and self.certificate.type == 'certificate':
             return True
-        return self.course_finished
+        return course_finished
 
     def get_current_class(self):
+        if hasattr(self, '_current_class'):
+            return self._current_class
         return Class.objects.get(students=self.user, course=self.course)
 
     def min_percent_to_complete(self):
         return self.course.min_percent_to_complete
 
+    def _last_unit_done(self):
+        return self.units_done.values_list('unit', flat=True).latest('complete')
+
     def reached_last_unit(self):
         try:
-            last_unit_done = self.units_done.latest('complete')
-            # try to get the next unit in same lesson
-            next_unit = Unit.objects \
-                .filter(lesson=last_unit_done.unit.lesson,
-                        position__gt=last_unit_done.unit.position) \
-                .order_by('position').first()
-
-            if next_unit:
-                return False
-            else:
-                next_lesson = self.course.lessons \
-                    .filter(position__gt=last_unit_done.unit.lesson.position) \
-                    .order_by('position').first()
-
-                if next_lesson and next_lesson.first_unit():
-                    return False
-                else:
-                    return True
+            last_unit_done = self._last_unit_done()
         except StudentProgress.DoesNotExist:
             return False
-        except AttributeError:
-            pass
-        return None
+        return self.course.get_outline().is_last_unit(last_unit_done)
 
     def resume_next_unit(self):
+        outline = self.course.get_outline()
         try:
-            last_unit_done = self.units_done.latest('complete')
-            # try to get the next unit in same lesson
-            next_unit = Unit.objects.filter(lesson=last_unit_done.unit.lesson,
-                                            position__gt=last_unit_done.unit.position).order_by(
-                'position').first()
-
-            if next_unit:
-                return next_unit
-            else:
-                next_lesson = self.course.lessons.filter(
-                    position__gt=last_unit_done.unit.lesson.position,
-                    status='published').order_by(
-                    'position').first()
-                if next_lesson and next_lesson.first_unit():
-                    return next_lesson.units.order_by('position').first()
-                else:
-                    return self.course.first_lesson().first_unit()
+            last_unit_done = self._last_unit_done()
         except StudentProgress.DoesNotExist:
-            first_lesson = self.course.first_lesson()
-            if first_lesson:
-                return first_lesson.first_unit()
-        except AttributeError:
-            pass
-        return None
+            return outline.first_unit()
+        # after the last unit of the course, start over from the beginning
+        return outline.next_unit(last_unit_done) or outline.first_unit()
 
     def percent_progress(self):
-        units_len = self.course.unit_set.count()
-        if units_len <= 0:
+        if self.total_units <= 0:
             return 0
-        units_done_len = self.units_done.count()
-        return int(100.0 * units_done_len / units_len)
+        return int(100.0 * self.completed_units / self.total_units)
 
     def units_done_by_lesson(self, lesson):
         return StudentProgress.objects.exclude(complete=None)\
@@ -444,37 +500,8 @@ class CourseStudent(models.Model):
         """
         Returns a list with dictionaries with keys name (lesson name), slug (lesson slug) and progress (percent lesson progress, decimal)
         """
-        # TODO refator to make one query to count unts done for all lessons
-        progress_list = []
-        for lesson in self.course.lessons.filter(status='published'):
-            lesson_progress = {}
-            lesson_progress['name'] = lesson.name
-            lesson_progress['slug'] = lesson.slug
-            lesson_progress['position'] = lesson.position
-            units_len = lesson.unit_count()
-            lesson_progress['activities'] = []
-            if units_len:
-                units_done_len = self.units_done_by_lesson(lesson).count()
-                lesson_progress['progress'] = 100 * units_done_len / units_len
-                lesson_progress['finish'] = self.get_lesson_finish_time(lesson)
-                activities = Activity.objects.filter(unit__lesson=lesson, type='discussion')
-                i = 0
-                for activity in activities:
-                    i = i + 1
-                    new_actv = {}
-                    new_actv['name'] = 'Atividade ' + str(i)
-                    new_actv['position'] = activity.unit.position
-                    ans = Answer.objects.filter(activity=activity, user=self.user)
-                    if ans:
-                        new_actv['done'] = 'true'
-                    else:
-                        new_actv['done'] = 'false'
-                    lesson_progress['activities'].append(new_actv)
-            else:
-                lesson_progress['progress'] = 0
-                lesson_progress['finish'] = ''
-            progress_list.append(lesson_progress)
-        return progress_list
+        from .progress import LessonProgressCalculator
+        return LessonProgressCalculator(self.course).for_users([self.user_id])[self.user_id]
 
     def forum_questions_by_lesson(self):
         return self.user.forum_questions.values('lesson').annotate(Count('lesson'))
@@ -483,6 +510,22 @@ class CourseStudent(models.Model):
         return self.user.forum_answers.values('question__lesson').annotate(Count('question__lesson'))
 
 
+def get_course_roles(user):
+    """
+    Returns a {course_id: role} dict with every course the user teaches.
+
+    The dict is loaded with one query and cached on the user instance, as
+    Django does with permissions, so all the role checks of a request
+    share it. Role changes are seen by the next request.
+    """
+    if user.is_anonymous():
+        return {}
+    if not hasattr(user, '_course_roles_cache'):
+        user._course_roles_cache = dict(CourseProfessor.objects.filter(user=user)
+                                        .values_list('course', 'role'))
+    return user._course_roles_cache
+
+
 class CourseProfessor(models.Model):
     ROLES = (
         ('instructor', _('Instructor')),
@@ -590,17 +633,202 @@ class ProfessorMessage(models.Model):
     date = models.DateTimeField(_('Date'), auto_now_add=True)
     course = models.ForeignKey(Course, verbose_name=_('Course'), null=True)
 
-    def send(self):
-        bcc = [u.email for u in self.users.all() if u.is_active and re.match(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)", u.email)]
+    @staticmethod
+    def read_exists_sql():
+        """SQL condition, taking a user id parameter, true when that user read the message."""
+        return ('EXISTS (SELECT 1 FROM %(read)s WHERE %(read)s.message_id = %(message)s.id '
+                'AND %(read)s.user_id = %%s AND %(read)s.is_read)') % {
+            'read': ProfessorMessageRead._meta.db_table,
+            'message': ProfessorMessage._meta.db_table,
+        }
+
+    @classmethod
+    def for_user(cls, user, unread=False):
+        """
+        Messages received by the user, annotated with user_has_read by a
+        single EXISTS subquery. With unread, read messages are left out.
+        """
+        queryset = cls.objects.filter(users=user)
+        if unread:
+            queryset = queryset.extra(where=['NOT ' + cls.read_exists_sql()], params=[user.id])
+        return queryset.extra(select={'user_has_read': cls.read_exists_sql()},
+                              select_params=[user.id])
+
+    @classmethod
+    def unread_count(cls, user):
+        """
+        The number of unread messages of the user, read from the
+        unread_messages counter of the user row.
+        """
+        if user.is_anonymous():
+            return 0
+        return get_user_model().objects.filter(id=user.id) \
+            .values_list('unread_messages', flat=True).first() or 0
+
+    @staticmethod
+    def shift_unread_count(users, delta):
+        """Add delta to the unread_messages counter of a queryset of users."""
+        users.update(unread_messages=F('unread_messages') + delta)
+
+    @classmethod
+    @transaction.atomic
+    def rebuild_unread_counts(cls, user_ids=None):
+        """
+        Recompute the unread_messages counter of the users from scratch.
+
+        Returns the number of users whose counters had drifted.
+        """
+        User = get_user_model()
+        users = User.objects.all()
+        if user_ids is not None:
+            users = users.filter(id__in=list(user_ids))
+        user_field = ProfessorMessage.users.field.m2m_reverse_field_name()
+
+        received = dict(ProfessorMessage.users.through.objects
+                        .filter(**{user_field + '__in': users.values('id')})
+                        .order_by()
+                        .values_list(user_field)
+                        .annotate(Count('id')))
+        read = dict(ProfessorMessageRead.objects
+                    .filter(is_read=True, user__in=users.values('id'), message__users=F('user'))
+                    .order_by()
+                    .values_list('user')
+                    .annotate(Count('id')))
+
+        changed = 0
+        for pk, unread_messages in users.values_list('id', 'unread_messages').iterator():
+            unread = received.get(pk, 0) - read.get(pk, 0)
+            if unread != unread_messages:
+                User.objects.filter(id=pk).update(unread_messages=unread)
+                changed += 1
+        return changed
+
+    def add_recipients(self, users, chunk_size=5000):
+        """
+        Add the users of a queryset as recipients with chunked bulk inserts
+        on the through table, reading only ids, so memory stays flat for
+        any number of recipients.
+        """
+        Recipient = ProfessorMessage.users.through
+        message_column = ProfessorMessage.users.field.m2m_column_name()
+        user_column = ProfessorMessage.users.field.m2m_reverse_name()
+        user_ids = users.exclude(messages=self).order_by('id') \
+            .values_list('id', flat=True).distinct()
+
+        last_id = 0
+        while True:
+            chunk = list(user_ids.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            Recipient.objects.bulk_create([Recipient(**{message_column: self.id, user_column: user_id})
+                                           for user_id in chunk])
+            # the bulk insert sends no m2m_changed signal
+            ProfessorMessage.shift_unread_count(
+                get_user_model().objects.filter(id__in=chunk)
+                .exclude(id__in=self.read_status.filter(is_read=True).values('user')), 1)
+            last_id = chunk[-1]
+
+    def render(self):
         try:
             et = EmailTemplate.objects.get(name='professor-message')
         except EmailTemplate.DoesNotExist:
             et = EmailTemplate(name="professor-message", subject="{{subject}}", template="{{message|safe}}")
         subject = Template(et.subject).render(Context({'subject': self.subject}))
         message = Template(et.template).render(Context({'message': self.message}))
-        email = EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, [settings.DEFAULT_FROM_EMAIL, ], bcc)
-        email.content_subtype = "html"
-        return email.send()
+        return subject, message
+
+    def queue(self):
+        """
+        Put the message in the outbox. It is delivered right away unless
+        PROFESSOR_MESSAGE_ASYNC_DELIVERY is set, in which case the
+        send_professor_messages command delivers it.
+        """
+        delivery = ProfessorMessageDelivery.objects.create(message=self)
+        if not settings.PROFESSOR_MESSAGE_ASYNC_DELIVERY:
+            delivery.deliver()
+        return delivery
+
+    def send(self):
+        return ProfessorMessageDelivery.objects.create(message=self).deliver()
+
+
+class ProfessorMessageDelivery(models.Model):
+    """
+    Outbox entry of a ProfessorMessage. Recipients are sent in BCC chunks
+    of PROFESSOR_MESSAGE_BCC_SIZE over a single connection, and the last
+    recipient sent is stored after every chunk, so a failed delivery
+    resumes where it stopped. Any error marks the delivery as failed, and
+    deliveries left sending by a killed worker are reclaimed by
+    send_professor_messages --retry-failed after a timeout.
+    """
+    STATES = (
+        ('pending', _('Pending')),
+        ('sending', _('Sending')),
+        ('sent', _('Sent')),
+        ('failed', _('Failed')),
+    )
+    EMAIL_REGEX = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
+
+    message = models.ForeignKey(ProfessorMessage, verbose_name=_('ProfessorMessage'), related_name='deliveries')
+    status = models.CharField(_('Status'), choices=STATES, default=STATES[0][0], max_length=16)
+    created_date = models.DateTimeField(_('Created'), auto_now_add=True)
+    sent_date = models.DateTimeField(_('Sent'), null=True, blank=True)
+    started_date = models.DateTimeField(_('Started'), null=True, blank=True)
+    last_recipient = models.IntegerField(default=0, editable=False)
+    recipients_sent = models.IntegerField(_('Recipients sent'), default=0)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(_('Error'), blank=True)
+
+    class Meta:
+        verbose_name = _('Message delivery')
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.message.subject, self.status)
+
+    def deliver(self):
+        """Send the remaining recipients. Returns True if all were sent."""
+        recipients = self.message.users.filter(is_active=True).order_by('id') \
+            .values_list('id', 'email')
+        connection = get_connection()
+        self.status = 'sending'
+        self.started_date = timezone.now()
+        self.attempts += 1
+        self.save()
+        try:
+            subject, body = self.message.render()
+            connection.open()
+            while True:
+                chunk = list(recipients.filter(id__gt=self.last_recipient)[:settings.PROFESSOR_MESSAGE_BCC_SIZE])
+                if not chunk:
+                    break
+                bcc = [email for _, email in chunk if self.EMAIL_REGEX.match(email)]
+                if bcc:
+                    email = EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [settings.DEFAULT_FROM_EMAIL, ], bcc,
+                                         connection=connection)
+                    email.content_subtype = "html"
+                    email.send()
+                self.last_recipient = chunk[-1][0]
+                self.recipients_sent += len(bcc)
+                self.save(update_fields=['last_recipient', 'recipients_sent'])
+        except (smtplib.SMTPException, socket.error) as e:
+            return self._failed(unicode(e))
+        except Exception:
+            # e.g. template or encoding errors, never leave the delivery sending
+            return self._failed(traceback.format_exc().decode('utf-8', 'replace'))
+        finally:
+            connection.close()
+
+        self.status = 'sent'
+        self.sent_date = timezone.now()
+        self.error = ''
+        self.save()
+        return True
+
+    def _failed(self, error):
+        self.status = 'failed'
+        self.error = error
+        self.save()
+        return False
 
 
 class ProfessorMessageRead(models.Model):
@@ -614,6 +842,136 @@ class ProfessorMessageRead(models.Model):
     class Meta:
         unique_together = ('user', 'message')
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ProfessorMessageRead, cls).from_db(db, field_names, values)
+        # remember the stored state to shift the unread counter on save
+        if 'is_read' in field_names:
+            instance._loaded_is_read = instance.is_read
+        return instance
+
+    def is_received(self):
+        return ProfessorMessage.users.through.objects.filter(**{
+            ProfessorMessage.users.field.m2m_field_name(): self.message_id,
+            ProfessorMessage.users.field.m2m_reverse_field_name(): self.user_id,
+        }).exists()
+
+    @classmethod
+    def mark_read(cls, user, message_ids=None, up_to=None):
+        """
+        Mark as read the messages received by the user among message_ids,
+        or all of them with ids up to up_to, in a single upsert on
+        PostgreSQL, and decrement the unread counter of the user in the
+        same transaction. Returns how many messages were unread.
+        """
+        Recipient = ProfessorMessage.users.through
+        message_column = ProfessorMessage.users.field.m2m_column_name()
+        user_column = ProfessorMessage.users.field.m2m_reverse_name()
+
+        connection = connections[router.db_for_write(cls)]
+        with transaction.atomic(using=connection.alias):
+            if supports_upsert(connection):
+                qn = connection.ops.quote_name
+                if message_ids is not None:
+                    message_ids = list(message_ids) or [0]
+                    condition = 'IN (%s)' % ', '.join(['%s'] * len(message_ids))
+                    params = [user.id] + message_ids
+                else:
+                    condition = '<= %s'
+                    params = [user.id, up_to]
+                sql = ('INSERT INTO {read} ({user}, {message}, {is_read}) '
+                       'SELECT {recipient_user}, {recipient_message}, %s FROM {recipient} '
+                       'WHERE {recipient_user} = %s AND {recipient_message} {condition} '
+                       'ON CONFLICT ({user}, {message}) DO UPDATE SET {is_read} = EXCLUDED.{is_read} '
+                       'WHERE {read}.{is_read} = %s').format(
+                    read=qn(cls._meta.db_table),
+                    user=qn(cls._meta.get_field('user').column),
+                    message=qn(cls._meta.get_field('message').column),
+                    is_read=qn(cls._meta.get_field('is_read').column),
+                    recipient=qn(Recipient._meta.db_table),
+                    recipient_user=qn(user_column),
+                    recipient_message=qn(message_column),
+                    condition=condition)
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, [True] + params + [False])
+                    marked = cursor.rowcount
+            else:
+                received = Recipient.objects.filter(**{user_column: user.id})
+                if message_ids is not None:
+                    received = received.filter(**{message_column + '__in': list(message_ids)})
+                else:
+                    received = received.filter(**{message_column + '__lte': up_to})
+                received = set(received.values_list(message_column, flat=True))
+                marked = cls.objects.filter(user=user, message__in=received, is_read=False) \
+                    .update(is_read=True)
+                existing = set(cls.objects.filter(user=user, message__in=received)
+                               .values_list('message', flat=True))
+                cls.objects.bulk_create([cls(user=user, message_id=message_id, is_read=True)
+                                         for message_id in received - existing])
+                marked += len(received - existing)
+
+            if marked:
+                # the upsert and the bulk insert send no signals
+                ProfessorMessage.shift_unread_count(get_user_model().objects.filter(id=user.id), -marked)
+        return marked
+
+
+def message_read_saved(sender, instance, **kwargs):
+    """Keep the unread_messages counter of the user in sync with its read states."""
+    delta = int(instance.is_read) - int(getattr(instance, '_loaded_is_read', False))
+    instance._loaded_is_read = instance.is_read
+    if delta and instance.is_received():
+        ProfessorMessage.shift_unread_count(get_user_model().objects.filter(id=instance.user_id), -delta)
+
+
+def message_read_deleted(sender, instance, **kwargs):
+    if getattr(instance, '_loaded_is_read', instance.is_read) and instance.is_received():
+        ProfessorMessage.shift_unread_count(get_user_model().objects.filter(id=instance.user_id), 1)
+
+
+def message_recipients_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Added recipients are counted with F() updates. Removals are rare, so
+    the counters of the affected users are recomputed once they are gone.
+    """
+    User = get_user_model()
+    if action == 'post_add' and pk_set:
+        if reverse:
+            unread = ProfessorMessage.objects.filter(id__in=pk_set) \
+                .extra(where=['NOT ' + ProfessorMessage.read_exists_sql()], params=[instance.pk]) \
+                .count()
+            if unread:
+                ProfessorMessage.shift_unread_count(User.objects.filter(id=instance.pk), unread)
+        else:
+            readers = instance.read_status.filter(is_read=True).values('user')
+            ProfessorMessage.shift_unread_count(
+                User.objects.filter(id__in=pk_set).exclude(id__in=readers), 1)
+    elif action in ('pre_remove', 'pre_clear'):
+        if reverse:
+            instance._unread_recount = [instance.pk]
+        elif action == 'pre_remove':
+            instance._unread_recount = list(pk_set)
+        else:
+            instance._unread_recount = list(instance.users.values_list('id', flat=True))
+    elif action in ('post_remove', 'post_clear'):
+        ProfessorMessage.rebuild_unread_counts(getattr(instance, '_unread_recount', []))
+
+
+def message_pre_delete(sender, instance, **kwargs):
+    # the recipients are deleted without m2m_changed signals
+    instance._unread_recount = list(instance.users.values_list('id', flat=True))
+
+
+def message_post_delete(sender, instance, **kwargs):
+    ProfessorMessage.rebuild_unread_counts(instance._unread_recount)
+
+
+post_save.connect(message_read_saved, sender=ProfessorMessageRead)
+post_delete.connect(message_read_deleted, sender=ProfessorMessageRead)
+m2m_changed.connect(message_recipients_changed, sender=ProfessorMessage.users.through)
+pre_delete.connect(message_pre_delete, sender=ProfessorMessage)
+post_delete.connect(message_post_delete, sender=ProfessorMessage)
+
 
 class PositionedModel(models.Model):
     collection_name = 'pk'
@@ -652,8 +1010,7 @@ class Lesson(PositionedModel):
 
     @property
     def is_course_last_lesson(self):
-        lessons = list(self.course.public_lessons)
-        return len(lessons) > 0 and self == lessons[-1]
+        return CourseOutline.get(self.course_id).is_last_lesson(self.id)
 
     class Meta:
         verbose_name = _('Lesson')
@@ -686,11 +1043,7 @@ class Lesson(PositionedModel):
         return self.status == 'published' and self.units.exists()
 
     def first_unit(self):
-        if self.units.exists():
-            try:
-                return self.units.order_by('position').first()
-            except AttributeError:
-                return None
+        return CourseOutline.get(self.course_id).first_unit(self.id)
 
 
 class Unit(PositionedModel):
@@ -713,6 +1066,130 @@ class Unit(PositionedModel):
         return u'%s - %s' % (self.title, self.position)
 
 
+class CourseOutline(object):
+    """
+    Ordered lessons and units of a course with constant time navigation
+    lookups. Navigation between units only walks published lessons.
+
+    Outlines are cached under Course.outline_changed, which is bumped in
+    the database whenever the course or one of its lessons or units is
+    saved or deleted, so every process sees the change even when the cache
+    is not shared. Always get them through CourseOutline.get.
+    """
+    CACHE_KEY = 'course-outline-%d-%s'
+
+    def __init__(self, course_id):
+        self.course_id = course_id
+        self.course_slug = Course.objects.filter(id=course_id) \
+            .values_list('slug', flat=True).first()
+        self.lessons = list(Lesson.objects.filter(course=course_id).order_by('position'))
+        self.public_lessons = [lesson for lesson in self.lessons if lesson.status != 'draft']
+
+        self.lesson_units = dict((lesson.id, []) for lesson in self.lessons)
+        lessons_by_id = dict((lesson.id, lesson) for lesson in self.lessons)
+        for unit in Unit.objects.filter(lesson__course=course_id).order_by('position'):
+            unit.lesson = lessons_by_id[unit.lesson_id]
+            self.lesson_units[unit.lesson_id].append(unit)
+
+        self.units = [unit for lesson in self.public_lessons
+                      for unit in self.lesson_units[lesson.id]]
+
+        self._lesson_index = dict((lesson.id, i) for i, lesson in enumerate(self.lessons))
+        self._public_lesson_index = dict((lesson.id, i) for i, lesson in enumerate(self.public_lessons))
+        self._unit_index = dict((unit.id, i) for i, unit in enumerate(self.units))
+
+    @classmethod
+    def get(cls, course_id):
+        changed = Course.objects.filter(id=course_id) \
+            .values_list('outline_changed', flat=True).first()
+        key = cls.CACHE_KEY % (course_id, changed.isoformat() if changed else '')
+        outline = cache.get(key)
+        if outline is None:
+            outline = cls(course_id)
+            cache.set(key, outline, settings.COURSE_OUTLINE_CACHE_TIMEOUT)
+        return outline
+
+    @classmethod
+    def invalidate(cls, course_id):
+        # the old outline is never read again and expires from the cache
+        Course.objects.filter(id=course_id).update(outline_changed=timezone.now())
+
+    def _lessons(self, include_drafts):
+        if include_drafts:
+            return self.lessons, self._lesson_index
+        return self.public_lessons, self._public_lesson_index
+
+    def first_lesson(self, include_drafts=False):
+        lessons, _ = self._lessons(include_drafts)
+        return lessons[0] if lessons else None
+
+    def last_lesson(self, include_drafts=False):
+        lessons, _ = self._lessons(include_drafts)
+        return lessons[-1] if lessons else None
+
+    def next_lesson(self, lesson_id, include_drafts=False):
+        lessons, index = self._lessons(include_drafts)
+        i = index.get(lesson_id)
+        if i is not None and i + 1 < len(lessons):
+            return lessons[i + 1]
+
+    def previous_lesson(self, lesson_id, include_drafts=False):
+        lessons, index = self._lessons(include_drafts)
+        i = index.get(lesson_id)
+        if i:
+            return lessons[i - 1]
+
+    def is_last_lesson(self, lesson_id):
+        last_lesson = self.last_lesson()
+        return last_lesson is not None and last_lesson.id == lesson_id
+
+    def first_unit(self, lesson_id=None):
+        """First unit of the given lesson, or of the whole course."""
+        if lesson_id is None:
+            units = self.units
+        else:
+            units = self.lesson_units.get(lesson_id, [])
+        return units[0] if units else None
+
+    def last_unit(self):
+        return self.units[-1] if self.units else None
+
+    def next_unit(self, unit_id):
+        i = self._unit_index.get(unit_id)
+        if i is not None and i + 1 < len(self.units):
+            return self.units[i + 1]
+
+    def previous_unit(self, unit_id):
+        i = self._unit_index.get(unit_id)
+        if i:
+            return self.units[i - 1]
+
+    def is_last_unit(self, unit_id):
+        last_unit = self.last_unit()
+        return last_unit is not None and last_unit.id == unit_id
+
+
+def invalidate_course_outline(sender, instance, **kwargs):
+    if isinstance(instance, Course):
+        course_id = instance.id
+    elif isinstance(instance, Lesson):
+        course_id = instance.course_id
+    else:
+        try:
+            course_id = instance.lesson.course_id
+        except Lesson.DoesNotExist:
+            return
+    CourseOutline.invalidate(course_id)
+
+
+post_save.connect(invalidate_course_outline, sender=Course)
+post_delete.connect(invalidate_course_outline, sender=Course)
+post_save.connect(invalidate_course_outline, sender=Lesson)
+post_delete.connect(invalidate_course_outline, sender=Lesson)
+post_save.connect(invalidate_course_outline, sender=Unit)
+post_delete.connect(invalidate_course_outline, sender=Unit)
+
+
 class StudentProgress(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              verbose_name=_('Student'))
@@ -729,6 +1206,56 @@ class StudentProgress(models.Model):
         return u'%s @ %s c: %s la: %s' % (
             self.user, self.unit, self.complete, self.last_access)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(StudentProgress, cls).from_db(db, field_names, values)
+        # remember the stored completion to detect transitions on save
+        if 'complete' in field_names:
+            instance._loaded_complete = instance.complete
+        return instance
+
+
+def shift_completed_units(progress, delta):
+    CourseStudent.objects.filter(
+        user_id=progress.user_id,
+        course__lessons__units__id=progress.unit_id
+    ).update(completed_units=F('completed_units') + delta)
+
+
+def _shift_total_units(unit, delta):
+    CourseStudent.objects.filter(course__lessons__id=unit.lesson_id) \
+        .update(total_units=F('total_units') + delta)
+
+
+def progress_saved(sender, instance, **kwargs):
+    """Keep CourseStudent.completed_units in sync when a unit is completed."""
+    was_complete = getattr(instance, '_loaded_complete', None) is not None
+    delta = int(instance.complete is not None) - int(was_complete)
+    instance._loaded_complete = instance.complete
+    if delta:
+        shift_completed_units(instance, delta)
+
+
+def progress_deleted(sender, instance, **kwargs):
+    if getattr(instance, '_loaded_complete', instance.complete) is not None:
+        shift_completed_units(instance, -1)
+
+
+def unit_saved(sender, instance, created, **kwargs):
+    """Keep CourseStudent.total_units in sync when units are added or removed."""
+    if created:
+        _shift_total_units(instance, 1)
+
+
+def unit_deleted(sender, instance, **kwargs):
+    _shift_total_units(instance, -1)
+
+
+post_save.connect(progress_saved, sender=StudentProgress)
+post_delete.connect(progress_deleted, sender=StudentProgress)
+post_save.connect(unit_saved, sender=Unit)
+post_delete.connect(unit_deleted, sender=Unit)
+
 
 class CourseCertification(models.Model):
     TYPES = (
@@ -759,8 +1286,11 @@ class CourseCertification(models.Model):
 
     @property
     def get_approved_process(self):
-        return CertificationProcess.objects.get(course_certification=self.id,
-                                                approved=True)
+        # iterate over processes.all() so prefetched processes are reused
+        for process in self.processes.all():
+            if process.approved:
+                return process
+        raise CertificationProcess.DoesNotExist
 
     @property
     def get_absolute_url(self):
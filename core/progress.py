@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, Max, Value, When
+from django.utils import timezone
+
+from activities.models import Activity, Answer
+from .models import Course, CourseStudent, StudentProgress, Unit, shift_completed_units
+from .progress_buffer import buffer_progress_access
+from .utils import upsert
+
+INSERT_ATTEMPTS = 3
+
+
+class LessonProgressCalculator(object):
+    """
+    Computes the per-lesson progress of many students of a course with a
+    fixed number of grouped queries, no matter how many lessons or
+    activities the course has.
+
+    The result for each student has the same structure returned by
+    CourseStudent.percent_progress_by_lesson().
+    """
+
+    def __init__(self, course):
+        self.course = course
+        self.lessons = list(course.lessons.filter(status='published')
+                            .values('id', 'name', 'slug', 'position')
+                            .annotate(units_count=Count('units')))
+        self.lesson_ids = [lesson['id'] for lesson in self.lessons]
+
+        self.activities = {}
+        if self.lesson_ids:
+            activities = Activity.objects \
+                .filter(unit__lesson__in=self.lesson_ids, type='discussion') \
+                .values_list('id', 'unit__lesson', 'unit__position')
+            for activity_id, lesson_id, position in activities:
+                self.activities.setdefault(lesson_id, []).append((activity_id, position))
+        self.activity_ids = [activity_id
+                             for lesson_activities in self.activities.values()
+                             for activity_id, _ in lesson_activities]
+
+    def for_users(self, user_ids):
+        """Returns a dict mapping each user id to its lessons progress list."""
+        user_ids = list(user_ids)
+
+        units_done = {}
+        answered = set()
+        if user_ids and self.lesson_ids:
+            done = StudentProgress.objects.exclude(complete=None) \
+                .filter(user__in=user_ids, unit__lesson__in=self.lesson_ids) \
+                .order_by() \
+                .values_list('user', 'unit__lesson') \
+                .annotate(Count('id'), Max('complete'))
+            for user_id, lesson_id, count, finish in done:
+                units_done[user_id, lesson_id] = (count, finish)
+
+        if user_ids and self.activity_ids:
+            answered = set(Answer.objects
+                           .filter(user__in=user_ids, activity__in=self.activity_ids)
+                           .order_by()
+                           .values_list('user', 'activity')
+                           .distinct())
+
+        return dict((user_id, self._progress_list(user_id, units_done, answered))
+                    for user_id in user_ids)
+
+    def _progress_list(self, user_id, units_done, answered):
+        progress_list = []
+        for lesson in self.lessons:
+            lesson_progress = {}
+            lesson_progress['name'] = lesson['name']
+            lesson_progress['slug'] = lesson['slug']
+            lesson_progress['position'] = lesson['position']
+            lesson_progress['activities'] = []
+            units_len = lesson['units_count']
+            if units_len:
+                units_done_len, finish = units_done.get((user_id, lesson['id']), (0, ''))
+                lesson_progress['progress'] = 100 * units_done_len / units_len
+                lesson_progress['finish'] = finish
+                for i, (activity_id, position) in enumerate(self.activities.get(lesson['id'], []), 1):
+                    new_actv = {}
+                    new_actv['name'] = 'Atividade ' + str(i)
+                    new_actv['position'] = position
+                    if (user_id, activity_id) in answered:
+                        new_actv['done'] = 'true'
+                    else:
+                        new_actv['done'] = 'false'
+                    lesson_progress['activities'].append(new_actv)
+            else:
+                lesson_progress['progress'] = 0
+                lesson_progress['finish'] = ''
+            progress_list.append(lesson_progress)
+        return progress_list
+
+
+class ClassProgressCalculator(object):
+    """
+    Computes course_finished and the current class of every student of a
+    class with a fixed number of queries. The returned CourseStudent
+    instances carry the results, so course_finished, can_emmit_receipt()
+    and get_current_class() do not query again.
+    """
+
+    def __init__(self, klass):
+        self.klass = klass
+        self.course = klass.course
+
+    def get_students(self):
+        students = list(self.klass.get_students
+                        .select_related('user', 'certificate')
+                        .prefetch_related('certificate__processes__evaluation'))
+
+        activities = Activity.objects.filter(unit__lesson__course=self.course,
+                                             unit__lesson__status='published',
+                                             type='discussion')
+        activities_count = activities.count()
+        answers = dict(Answer.objects
+                       .filter(activity__in=activities, user__in=self.klass.students.all())
+                       .order_by()
+                       .values_list('user')
+                       .annotate(Count('id')))
+
+        min_percent = self.course.min_percent_to_complete
+        for student in students:
+            student.course = self.course
+            student._current_class = self.klass
+            # the same rule as CourseStudent._plpc_course_finished
+            student._finished = student.percent_progress() > min_percent and \
+                activities_count == answers.get(student.user_id, 0)
+        return students
+
+
+@transaction.atomic
+def rebuild_progress_counters(courses=None):
+    """
+    Recompute CourseStudent.completed_units and total_units from scratch.
+
+    Returns the number of enrollments whose counters had drifted.
+    """
+    if courses is None:
+        courses = Course.objects.all()
+
+    totals = dict(Unit.objects.filter(lesson__course__in=courses)
+                  .order_by()
+                  .values_list('lesson__course')
+                  .annotate(Count('id')))
+
+    changed = 0
+    for course_id in courses.values_list('id', flat=True):
+        completed = dict(StudentProgress.objects
+                         .exclude(complete=None)
+                         .filter(unit__lesson__course=course_id)
+                         .order_by()
+                         .values_list('user')
+                         .annotate(Count('id')))
+        total = totals.get(course_id, 0)
+
+        enrollments = CourseStudent.objects.filter(course=course_id) \
+            .values_list('id', 'user', 'completed_units', 'total_units')
+        for pk, user_id, completed_units, total_units in enrollments.iterator():
+            done = completed.get(user_id, 0)
+            if (done, total) != (completed_units, total_units):
+                CourseStudent.objects.filter(id=pk) \
+                    .update(completed_units=done, total_units=total)
+                changed += 1
+    return changed
+
+
+def record_progress(user, unit_id, is_complete):
+    """
+    Record an access of a user to a unit with a single upsert, so
+    concurrent requests for the same unit never fail. The first completion
+    timestamp is never overwritten. Plain accesses to existing rows go
+    through the write-behind buffer when it is enabled.
+
+    Returns the StudentProgress instance.
+    """
+    now = timezone.now()
+    values = {'user': user.id, 'unit': unit_id, 'last_access': now}
+    if is_complete:
+        values['complete'] = now
+        progress = upsert(StudentProgress, ('user', 'unit'), values,
+                          update_fields=('last_access',), keep_fields=('complete',))
+        # only the statement that completed the row stored our timestamp
+        if progress.complete == now:
+            shift_completed_units(progress, 1)
+    elif buffer_progress_access(user.id, [unit_id], now):
+        progress = upsert(StudentProgress, ('user', 'unit'), values)
+    else:
+        progress = upsert(StudentProgress, ('user', 'unit'), values,
+                          update_fields=('last_access',))
+    return progress
+
+
+@transaction.atomic
+def record_progress_events(user, events):
+    """
+    Apply a batch of unit access events of a user with set-based queries.
+    Plain accesses go through the write-behind buffer when it is enabled.
+
+    Each event is a dict with the keys unit (id), is_complete and an
+    optional timestamp. As in StudentProgressViewSet.create, the first
+    completion timestamp of a unit is never overwritten. Events for units
+    that do not exist are ignored. Rows inserted by a concurrent batch of
+    the same user are read again and updated instead.
+
+    Returns a queryset of the StudentProgress rows of the batch units.
+    """
+    now = timezone.now()
+    completions = {}
+    for event in events:
+        if event.get('is_complete'):
+            timestamp = min(event.get('timestamp') or now, now)
+            unit_id = event['unit']
+            completions[unit_id] = min(completions.get(unit_id, timestamp), timestamp)
+
+    unit_courses = dict(Unit.objects.filter(id__in=set(event['unit'] for event in events))
+                        .values_list('id', 'lesson__course'))
+    unit_ids = list(unit_courses)
+    for attempt in range(INSERT_ATTEMPTS):
+        existing = dict(StudentProgress.objects.filter(user=user, unit__in=unit_ids)
+                        .values_list('unit', 'complete'))
+        try:
+            with transaction.atomic():
+                StudentProgress.objects.bulk_create([
+                    StudentProgress(user=user, unit_id=unit_id, complete=completions.get(unit_id))
+                    for unit_id in unit_ids if unit_id not in existing])
+            break
+        except IntegrityError:
+            # a retried or concurrent batch of the same user inserted some
+            # of the rows first, read them again and update them instead
+            if attempt == INSERT_ATTEMPTS - 1:
+                raise
+
+    newly_completed = {}
+    for unit_id, course_id in unit_courses.items():
+        if unit_id not in existing and unit_id in completions:
+            newly_completed[course_id] = newly_completed.get(course_id, 0) + 1
+
+    to_complete = {}
+    for unit_id, complete in existing.items():
+        if complete is None and unit_id in completions:
+            to_complete.setdefault(unit_courses[unit_id], []).append(unit_id)
+    for course_id, course_units in to_complete.items():
+        whens = [When(unit=unit_id, then=Value(completions[unit_id])) for unit_id in course_units]
+        # only rows still incomplete are changed, so a concurrent completion wins
+        updated = StudentProgress.objects \
+            .filter(user=user, unit__in=course_units, complete=None) \
+            .update(last_access=now,
+                    complete=Case(*whens, output_field=models.DateTimeField()))
+        newly_completed[course_id] = newly_completed.get(course_id, 0) + updated
+
+    completing = set(u for course_units in to_complete.values() for u in course_units)
+    accessed = [unit_id for unit_id in existing if unit_id not in completing]
+    if accessed and not buffer_progress_access(user.id, accessed, now):
+        StudentProgress.objects.filter(user=user, unit__in=accessed) \
+            .update(last_access=now)
+
+    for course_id, count in newly_completed.items():
+        if count:
+            CourseStudent.objects.filter(user=user, course=course_id) \
+                .update(completed_units=F('completed_units') + count)
+
+    return StudentProgress.objects.filter(user=user, unit__in=unit_ids) \
+        .select_related('user')
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind buffering of StudentProgress.last_access updates.
+
+When settings.STUDENT_PROGRESS_WRITE_BEHIND is 'memory' (one buffer per
+process) or 'cache' (shared through the cache backend), unit visits that
+do not complete a unit are buffered here and written in bulk about once
+every STUDENT_PROGRESS_FLUSH_INTERVAL seconds, or by the
+flush_progress_access command. Completions are always written synchronously.
+
+The 'cache' mode needs a cache shared by every process (e.g. memcached),
+so it is refused with the default per-process local memory cache.
+"""
+import atexit
+import logging
+import operator
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import Case, DateTimeField, F, Q, Value, When
+
+from .models import StudentProgress
+
+logger = logging.getLogger(__name__)
+
+FLUSH_BATCH_SIZE = 500
+# cache backends that are not shared between processes
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def write_progress_access(accesses):
+    """
+    Update last_access from a {(user_id, unit_id): timestamp} dict, never
+    moving a row back in time. Returns the number of buffered accesses.
+    """
+    items = list(accesses.items())
+    for start in range(0, len(items), FLUSH_BATCH_SIZE):
+        batch = items[start:start + FLUSH_BATCH_SIZE]
+        # only the buffered pairs that are still older are written
+        stale = [Q(user=user_id, unit=unit_id, last_access__lt=timestamp)
+                 for (user_id, unit_id), timestamp in batch]
+        whens = [When(user=user_id, unit=unit_id, then=Value(timestamp))
+                 for (user_id, unit_id), timestamp in batch]
+        StudentProgress.objects \
+            .filter(reduce(operator.or_, stale)) \
+            .update(last_access=Case(*whens, default=F('last_access'),
+                                     output_field=DateTimeField()))
+    return len(items)
+
+
+class MemoryAccessBuffer(object):
+    """
+    Buffers accesses in this process only. Besides the flushes done by
+    add(), a daemon thread flushes the buffer every interval, so a quiet
+    process does not hold accesses indefinitely, and the buffer is flushed
+    when the process exits.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.time()
+
+        flusher = threading.Thread(target=self._flush_periodically, name='progress-access-flush')
+        flusher.daemon = True
+        flusher.start()
+        atexit.register(self.flush)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            if time.time() - self.last_flush < self.interval:
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not flush the buffered progress accesses')
+            finally:
+                # the connection of this thread would otherwise stay open
+                connection.close()
+
+    def add(self, user_id, unit_ids, timestamp):
+        with self.lock:
+            for unit_id in unit_ids:
+                self.pending[user_id, unit_id] = timestamp
+            due = time.time() - self.last_flush >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+        try:
+            return write_progress_access(pending)
+        except Exception:
+            # keep the accesses for the next flush, newer ones win
+            with self.lock:
+                for key, timestamp in pending.items():
+                    self.pending[key] = max(self.pending.get(key, timestamp), timestamp)
+            raise
+
+
+class CacheAccessBuffer(object):
+    """
+    Buffers accesses in the cache, so every web worker shares the buffer
+    and the flush_progress_access command can drain it. Each access is
+    stored under its own sequence number, so no read-modify-write happens.
+    """
+    SEQ_KEY = 'progress-access-seq'
+    CURSOR_KEY = 'progress-access-flushed'
+    ENTRY_KEY = 'progress-access-%d'
+    LOCK_KEY = 'progress-access-flush-lock'
+
+    def __init__(self, interval):
+        backend = settings.CACHES['default']['BACKEND']
+        if backend in LOCAL_CACHE_BACKENDS:
+            raise ImproperlyConfigured(
+                "STUDENT_PROGRESS_WRITE_BEHIND = 'cache' needs a cache shared by every "
+                "process, but the default cache backend is %s" % backend)
+        self.interval = interval
+
+    def add(self, user_id, unit_ids, timestamp):
+        cache.add(self.SEQ_KEY, 0, None)
+        for unit_id in unit_ids:
+            seq = cache.incr(self.SEQ_KEY)
+            cache.set(self.ENTRY_KEY % seq, (user_id, unit_id, timestamp), None)
+        # the lock expires after the interval, so at most one request
+        # flushes the buffer in each interval
+        if cache.add(self.LOCK_KEY, True, self.interval):
+            self.flush()
+
+    def flush(self):
+        last = cache.get(self.SEQ_KEY) or 0
+        cursor = cache.get(self.CURSOR_KEY) or 0
+        if cursor > last:
+            # the sequence was evicted from the cache and started over
+            cursor = 0
+
+        flushed = 0
+        while cursor < last:
+            end = min(cursor + FLUSH_BATCH_SIZE, last)
+            keys = [self.ENTRY_KEY % seq for seq in range(cursor + 1, end + 1)]
+            accesses = {}
+            for user_id, unit_id, timestamp in cache.get_many(keys).values():
+                key = (user_id, unit_id)
+                accesses[key] = max(accesses.get(key, timestamp), timestamp)
+            flushed += write_progress_access(accesses)
+            cache.delete_many(keys)
+            cursor = end
+            cache.set(self.CURSOR_KEY, cursor, None)
+        return flushed
+
+
+BUFFER_CLASSES = {
+    'memory': MemoryAccessBuffer,
+    'cache': CacheAccessBuffer,
+}
+_buffers = {}
+
+
+def get_access_buffer():
+    """Returns the configured buffer, or None when write-behind is disabled."""
+    mode = settings.STUDENT_PROGRESS_WRITE_BEHIND
+    if not mode:
+        return None
+    if mode not in _buffers:
+        _buffers[mode] = BUFFER_CLASSES[mode](settings.STUDENT_PROGRESS_FLUSH_INTERVAL)
+    return _buffers[mode]
+
+
+def buffer_progress_access(user_id, unit_ids, timestamp):
+    """
+    Buffer the access of a user to some units. Returns False when
+    write-behind is disabled and the caller must write the rows itself.
+    """
+    access_buffer = get_access_buffer()
+    if access_buffer is None:
+        return False
+    access_buffer.add(user_id, unit_ids, timestamp)
+    return True
@@ -5,11 +5,12 @@ from core.models import (Course, CourseProfessor, CourseStudent, Lesson,
                          Video, StudentProgress, Unit, ProfessorMessage,
                          ProfessorMessageRead, Class, CourseAuthor,
                          CourseCertification, CertificationProcess, Evaluation,
-                         CertificateTemplate, )
+                         CertificateTemplate, CourseOutline, )
 from accounts.serializers import TimtecUserSerializer, \
     TimtecUserAdminCertificateSerializer
 from activities.models import Activity, Answer
 from activities.serializers import ActivitySerializer, AnswerSerializer
+from core.progress import ClassProgressCalculator
 from notes.models import Note
 from rest_framework import serializers
 
@@ -21,6 +22,16 @@ class ProfessorMessageReadSerializer(serializers.ModelSerializer):
         fields = ('id', 'message', 'is_read')
 
 
+class ProfessorMessageReadBulkSerializer(serializers.Serializer):
+    messages = serializers.ListField(child=serializers.IntegerField(), required=False)
+    up_to = serializers.IntegerField(required=False)
+
+    def validate(self, data):
+        if 'messages' not in data and 'up_to' not in data:
+            raise serializers.ValidationError('Either messages or up_to is required.')
+        return data
+
+
 class ProfessorMessageSerializer(serializers.ModelSerializer):
 
     professor = TimtecUserSerializer(read_only=True)
@@ -45,6 +56,9 @@ class ProfessorMessageSerializer(serializers.ModelSerializer):
             return ''  # no course is associated with this message
 
     def get_is_read(self, obj):
+        # annotated by ProfessorMessage.for_user
+        if hasattr(obj, 'user_has_read'):
+            return bool(obj.user_has_read)
         try:
             read_state = ProfessorMessageRead.objects.get(user=self.context['request'].user, message=obj)
             return read_state.is_read
@@ -69,16 +83,15 @@ class ProfessorGlobalMessageSerializer(ProfessorMessageSerializer):
         User = get_user_model()
         if all_students:
             # If all_students was set to True by the client, this is a global message
-            global_message.users.add(*[user for user in User.objects.all()])
+            global_message.add_recipients(User.objects.all())
         elif groups:
             # If groups were specified, their users are the recipients
-            global_message.users.add(*[user for user in User.objects.filter(groups__in=groups)])
+            global_message.add_recipients(User.objects.filter(groups__in=groups))
         elif recipients:
             # Otherwise, user the recipients list
-            for user_id in self.context['request'].data['users']:
-                global_message.users.add(User.objects.get(id=user_id))
+            global_message.add_recipients(User.objects.filter(id__in=recipients))
 
-        global_message.send()
+        global_message.queue()
         return global_message
 
 
@@ -156,7 +169,7 @@ class CourseCertificationSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_course(obj):
-        return obj.course.id
+        return obj.course_student.course_id
 
 
 class EvaluationSerializer(serializers.ModelSerializer):
@@ -229,6 +242,12 @@ class CourseSerializer(serializers.ModelSerializer):
                   "min_percent_to_complete", "is_user_assistant", "is_user_coordinator",
                   "is_assistant_or_coordinator", 'professors', )
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Load everything the serializer reads with a fixed number of queries."""
+        return queryset.select_related('intro_video') \
+            .prefetch_related('professors', 'course_authors__user')
+
     @staticmethod
     def get_home_thumbnail_url(obj):
         if obj.home_thumbnail:
@@ -311,7 +330,7 @@ class ProfileCourseCertificationSerializer(serializers.ModelSerializer):
 
 
 class ClassSerializer(serializers.ModelSerializer):
-    students_details = CourseStudentClassSerializer(source='get_students', many=True, read_only=True)
+    students_details = serializers.SerializerMethodField()
     processes = CertificationProcessSerializer(read_only=True, many=True)
     evaluations = EvaluationSerializer(read_only=True, many=True)
     course = CourseSerializer(read_only=True)
@@ -320,6 +339,10 @@ class ClassSerializer(serializers.ModelSerializer):
     class Meta:
         model = Class
 
+    def get_students_details(self, obj):
+        students = ClassProgressCalculator(obj).get_students()
+        return CourseStudentClassSerializer(students, many=True, context=self.context).data
+
     def update(self, instance, validated_data, **kwargs):
         assistants = self.context['request'].data.get('assistants', None)
         updated_class = super(ClassSerializer, self).update(instance, validated_data)
@@ -366,6 +389,12 @@ class StudentProgressSerializer(serializers.ModelSerializer):
         fields = ('unit', 'complete', 'user',)
 
 
+class StudentProgressEventSerializer(serializers.Serializer):
+    unit = serializers.IntegerField()
+    is_complete = serializers.BooleanField(required=False, default=False)
+    timestamp = serializers.DateTimeField(required=False)
+
+
 class UnitSerializer(serializers.ModelSerializer):
     video = VideoSerializer(required=False, allow_null=True)
     activities = ActivitySerializer(many=True, required=False, allow_null=True)
@@ -462,23 +491,20 @@ class SimpleLessonSerializer(LessonSerializer):
         fields = '__all__'
 
     def get_next_url(self, object):
-        course = object.course
         user = None
         request = self.context.get("request")
         if request and hasattr(request, "user"):
             user = request.user
 
-        if user and user.is_superuser:
-            lessons = list(course.lessons.all())
-        else:
-            lessons = list(course.public_lessons)
+        outline = CourseOutline.get(object.course_id)
+        next_lesson = outline.next_lesson(
+            object.id, include_drafts=bool(user and user.is_superuser))
 
-        if len(lessons) > 0 and object != lessons[-1]:
-            index = lessons.index(object)
-            reverse = reverse_lazy('lesson', args=[course.slug,
-                                                lessons[index + 1].slug])
+        if next_lesson:
+            reverse = reverse_lazy('lesson', args=[outline.course_slug,
+                                                   next_lesson.slug])
         else:
-            reverse = reverse_lazy('course_intro', args=[course.slug])
+            reverse = reverse_lazy('course_intro', args=[outline.course_slug])
         return reverse
 
 class NoteSerializer(serializers.ModelSerializer):
@@ -1,9 +1,9 @@
 from django import template
-from core.models import CourseProfessor
+from core.models import get_course_roles
 
 register = template.Library()
 
 
 @register.filter
 def is_coordinator(user):
-    return CourseProfessor.objects.filter(user=user, role='coordinator').exists()
+    return 'coordinator' in get_course_roles(user).values()
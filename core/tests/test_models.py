@@ -157,6 +157,7 @@ def test_studentprogress_emmit_receipt(user):
                complete=datetime.now())
     assert course_student.resume_next_unit() == unit3
     assert course_student.reached_last_unit() is False
+    course_student.refresh_from_db()
     assert course_student.course_finished is False
     assert course_student.can_emmit_receipt() is False
 
@@ -164,6 +165,7 @@ def test_studentprogress_emmit_receipt(user):
                complete=datetime.now())
     assert course_student.resume_next_unit() == unit1
     assert course_student.reached_last_unit() is True
+    course_student.refresh_from_db()
     assert course_student.course_finished is True
     assert course_student.can_emmit_receipt() is True
     # Once he/she reaches the end of the course, even with profile not filled
@@ -177,6 +179,7 @@ def test_studentprogress_emmit_receipt(user):
 
     assert course_student.resume_next_unit() == unit1
     assert course_student.reached_last_unit() is True
+    course_student.refresh_from_db()
     assert course_student.course_finished is True
     assert course_student.can_emmit_receipt() is True
 
@@ -185,3 +188,359 @@ def test_studentprogress_emmit_receipt(user):
                    course_student=course_student)
     except Exception as e:
         assert type(e).__name__ == "IntegrityError"
+
+
+@pytest.mark.django_db
+def test_progress_counters(user):
+    from datetime import datetime
+    from core.progress import rebuild_progress_counters
+
+    course = mommy.make('Course')
+    lesson = mommy.make('Lesson', course=course, status='published')
+    unit1 = mommy.make('Unit', lesson=lesson)
+    unit2 = mommy.make('Unit', lesson=lesson)
+    course_student = mommy.make('CourseStudent', user=user, course=course)
+    assert course_student.total_units == 2
+    assert course_student.percent_progress() == 0
+
+    unit3 = mommy.make('Unit', lesson=lesson)
+    progress = mommy.make('StudentProgress', user=user, unit=unit1)
+    course_student.refresh_from_db()
+    assert course_student.total_units == 3
+    assert course_student.completed_units == 0
+
+    progress.complete = datetime.now()
+    progress.save()
+    mommy.make('StudentProgress', user=user, unit=unit2, complete=datetime.now())
+    # saving an instance loaded before keeps the counters made meanwhile
+    course_student.save()
+    course_student.refresh_from_db()
+    assert course_student.completed_units == 2
+    assert course_student.percent_progress() == 66
+
+    # saving an already completed unit does not count it twice
+    progress.save()
+    unit3.delete()
+    unit2.delete()
+    course_student.refresh_from_db()
+    assert course_student.completed_units == 1
+    assert course_student.total_units == 1
+
+    CourseStudent.objects.filter(id=course_student.id).update(completed_units=7, total_units=0)
+    assert rebuild_progress_counters() == 1
+    course_student.refresh_from_db()
+    assert course_student.completed_units == 1
+    assert course_student.total_units == 1
+
+
+@pytest.mark.django_db
+def test_percent_progress_by_lesson_query_count(user):
+    from datetime import datetime
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    course = mommy.make('Course')
+    course_student = mommy.make('CourseStudent', course=course, user=user)
+    for position in range(5):
+        lesson = mommy.make('Lesson', course=course, status='published', position=position)
+        unit = mommy.make('Unit', lesson=lesson)
+        mommy.make('Unit', lesson=lesson)
+        activity = mommy.make('Activity', unit=unit, type='discussion')
+        mommy.make('Activity', unit=unit, type='discussion')
+        mommy.make('StudentProgress', user=user, unit=unit, complete=datetime.now())
+        mommy.make('activities.Answer', user=user, activity=activity, given={})
+
+    with CaptureQueriesContext(connection) as queries:
+        progress = course_student.percent_progress_by_lesson()
+
+    assert len(queries) <= 5
+    assert len(progress) == 5
+    for lesson_progress in progress:
+        assert lesson_progress['progress'] == 50
+        assert lesson_progress['finish'] != ''
+        assert [a['name'] for a in lesson_progress['activities']] == ['Atividade 1', 'Atividade 2']
+        assert [a['done'] for a in lesson_progress['activities']] == ['true', 'false']
+
+
+@pytest.mark.django_db
+def test_avg_lessons_users_progress(user):
+    from datetime import datetime
+    from django.core.cache import cache
+    from conftest import create_user
+
+    cache.clear()
+    course = mommy.make('Course')
+    lesson = mommy.make('Lesson', course=course, status='published')
+    unit1 = mommy.make('Unit', lesson=lesson)
+    unit2 = mommy.make('Unit', lesson=lesson)
+    other = create_user('other')
+    course.enroll_student(user)
+    course.enroll_student(other)
+    extra_class = mommy.make('Class', course=course)
+    mommy.make('StudentProgress', user=user, unit=unit1, complete=datetime.now())
+    mommy.make('StudentProgress', user=user, unit=unit2, complete=datetime.now())
+
+    assert course.avg_lessons_users_progress()[0]['progress'] == 50
+    classes = [course.default_class, extra_class]
+    assert course.avg_lessons_users_progress(classes)[0]['progress'] == 50
+
+    # results are cached
+    mommy.make('StudentProgress', user=other, unit=unit1, complete=datetime.now())
+    assert course.avg_lessons_users_progress()[0]['progress'] == 50
+    cache.clear()
+    assert course.avg_lessons_users_progress()[0]['progress'] == 75
+
+
+@pytest.mark.django_db
+def test_course_outline():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    course = mommy.make('Course')
+    lesson1 = mommy.make('Lesson', course=course, position=1, status='published')
+    draft = mommy.make('Lesson', course=course, position=2, status='draft')
+    lesson3 = mommy.make('Lesson', course=course, position=3, status='published')
+    unit1 = mommy.make('Unit', lesson=lesson1)
+    unit2 = mommy.make('Unit', lesson=lesson1)
+    draft_unit = mommy.make('Unit', lesson=draft)
+    unit3 = mommy.make('Unit', lesson=lesson3)
+
+    outline = course.get_outline()
+    with CaptureQueriesContext(connection) as queries:
+        outline = course.get_outline()
+        assert outline.first_unit() == unit1
+        assert outline.next_unit(unit1.id) == unit2
+        assert outline.next_unit(unit2.id) == unit3
+        assert outline.next_unit(unit3.id) is None
+        assert outline.previous_unit(unit3.id) == unit2
+        assert outline.is_last_unit(unit3.id)
+        assert outline.first_unit(draft.id) == draft_unit
+        assert outline.next_lesson(lesson1.id) == lesson3
+        assert outline.next_lesson(lesson1.id, include_drafts=True) == draft
+        assert outline.previous_lesson(lesson3.id) == lesson1
+        assert outline.is_last_lesson(lesson3.id)
+        assert outline.next_unit(unit1.id).lesson == lesson1
+    # only the outline version of the course is read
+    assert len(queries) == 1
+
+    # changes to the lessons invalidate the cached outline
+    lesson4 = mommy.make('Lesson', course=course, position=4, status='published')
+    assert lesson3.is_course_last_lesson is False
+    assert lesson4.is_course_last_lesson is True
+    unit3.delete()
+    assert course.get_outline().last_unit() == unit2
+
+
+@pytest.mark.django_db
+def test_course_roles_are_loaded_once_per_user(user):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    courses = mommy.make('Course', _quantity=5)
+    mommy.make('CourseProfessor', user=user, course=courses[0], role='coordinator')
+    mommy.make('CourseProfessor', user=user, course=courses[1], role='assistant')
+
+    with CaptureQueriesContext(connection) as queries:
+        for course in courses:
+            course.is_course_assistant(user)
+            course.is_course_coordinator(user)
+            course.is_assistant_or_coordinator(user)
+
+    assert len(queries) == 1
+    assert courses[0].get_professor_role(user) == 'coordinator'
+    assert courses[0].is_course_coordinator(user)
+    assert courses[1].is_course_assistant(user)
+    assert not courses[2].is_assistant_or_coordinator(user)
+
+
+@pytest.mark.django_db
+def test_class_progress_calculator():
+    from datetime import datetime
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from conftest import create_user
+    from core.progress import ClassProgressCalculator
+
+    course = mommy.make('Course', min_percent_to_complete=50)
+    lesson = mommy.make('Lesson', course=course, status='published')
+    units = mommy.make('Unit', lesson=lesson, _quantity=4)
+    activity = mommy.make('Activity', unit=units[0], type='discussion')
+    klass = course.default_class
+
+    for i in range(5):
+        student = create_user('student%d' % i)
+        course.enroll_student(student)
+        for unit in units[:i]:
+            mommy.make('StudentProgress', user=student, unit=unit, complete=datetime.now())
+        if i % 2:
+            mommy.make('activities.Answer', user=student, activity=activity, given={})
+
+    expected = dict((cs.user_id, (cs.course_finished, cs.can_emmit_receipt(), cs.percent_progress()))
+                    for cs in klass.get_students)
+
+    with CaptureQueriesContext(connection) as queries:
+        students = ClassProgressCalculator(klass).get_students()
+        result = dict((cs.user_id, (cs.course_finished, cs.can_emmit_receipt(), cs.percent_progress()))
+                      for cs in students)
+
+    assert result == expected
+    assert len(queries) <= 6
+
+
+@pytest.mark.django_db
+def test_course_bulk_enroll():
+    from datetime import datetime
+    from conftest import create_user
+    from core.models import CourseCertification, CourseStudent
+
+    course = mommy.make('Course')
+    lesson = mommy.make('Lesson', course=course)
+    unit1 = mommy.make('Unit', lesson=lesson)
+    mommy.make('Unit', lesson=lesson)
+    students = [create_user('student%d' % i) for i in range(5)]
+    course.enroll_student(students[0])
+    mommy.make('StudentProgress', user=students[1], unit=unit1, complete=datetime.now())
+
+    assert course.bulk_enroll([s.id for s in students], chunk_size=2) == 4
+    assert course.bulk_enroll([s.id for s in students]) == 0
+
+    enrollments = CourseStudent.objects.filter(course=course)
+    assert enrollments.count() == 5
+    assert set(cs.total_units for cs in enrollments) == set([2])
+    assert enrollments.get(user=students[1]).completed_units == 1
+    assert CourseCertification.objects.filter(course_student__course=course).count() == 5
+
+
+@pytest.mark.django_db
+def test_add_students_form_moves_and_enrolls_students():
+    from conftest import create_user
+    from core.forms import AddStudentsForm
+    from core.models import CourseStudent
+
+    course = mommy.make('Course')
+    klass = mommy.make('Class', course=course)
+    other_class = mommy.make('Class', course=course)
+    students = [create_user('student%d' % i) for i in range(3)]
+    other_class.students.add(students[0])
+    course.enroll_student(students[1])
+
+    form = AddStudentsForm(instance=klass, data={
+        'students_text': 'student0 student1@example.com nobody',
+        'auto_enroll': 'True',
+    })
+    assert form.is_valid()
+    form.save()
+
+    assert set(klass.students.all()) == set(students[:2])
+    assert not other_class.students.exists()
+    assert not course.default_class.students.exists()
+    assert set(CourseStudent.objects.filter(course=course).values_list('user', flat=True)) == \
+        set([students[0].id, students[1].id])
+
+
+@pytest.mark.django_db
+def test_adding_a_student_to_a_class_does_not_scan_the_class():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from conftest import create_user
+
+    course = mommy.make('Course')
+    klass = mommy.make('Class', course=course)
+    klass.students.add(*[create_user('student%d' % i) for i in range(10)])
+    student = create_user('new_student')
+    course.default_class.students.add(student)
+
+    with CaptureQueriesContext(connection) as queries:
+        klass.students.add(student)
+    assert len(queries) <= 6
+    assert klass.students.filter(id=student.id).exists()
+    assert not course.default_class.students.filter(id=student.id).exists()
+
+    klass.students.clear()
+    assert course.default_class.students.count() == 11
+
+
+@pytest.mark.django_db
+def test_professor_message_delivery_in_bcc_chunks(settings):
+    from django.core import mail
+    from django.core.management import call_command
+    from conftest import create_user
+    from core.models import ProfessorMessage
+
+    settings.PROFESSOR_MESSAGE_BCC_SIZE = 2
+    settings.PROFESSOR_MESSAGE_ASYNC_DELIVERY = True
+    message = mommy.make('ProfessorMessage', subject='Hello', message='World')
+    users = [create_user('student%d' % i) for i in range(5)]
+    users[4].email = 'invalid'
+    users[4].save()
+    message.users.add(*users)
+
+    delivery = message.queue()
+    assert len(mail.outbox) == 0
+    assert delivery.status == 'pending'
+
+    call_command('send_professor_messages')
+    delivery.refresh_from_db()
+    assert delivery.status == 'sent'
+    assert delivery.recipients_sent == 4
+    assert [len(email.bcc) for email in mail.outbox] == [2, 2]
+    assert ProfessorMessage.objects.get(id=message.id).deliveries.count() == 1
+
+
+@pytest.mark.django_db
+def test_professor_message_delivery_failures_are_retried(settings, monkeypatch):
+    from datetime import timedelta
+    from django.core import mail
+    from django.core.management import call_command
+    from django.utils import timezone
+    from conftest import create_user
+    from core.models import ProfessorMessage, ProfessorMessageDelivery
+
+    settings.PROFESSOR_MESSAGE_ASYNC_DELIVERY = True
+    message = mommy.make('ProfessorMessage', subject='Hello', message='World')
+    message.users.add(create_user('student'))
+
+    # any error marks the delivery as failed
+    monkeypatch.setattr(ProfessorMessage, 'render', lambda self: 1 / 0)
+    delivery = message.queue()
+    call_command('send_professor_messages')
+    monkeypatch.undo()
+    delivery.refresh_from_db()
+    assert delivery.status == 'failed'
+    assert 'ZeroDivisionError' in delivery.error
+
+    # a delivery left sending by a killed worker is reclaimed after the timeout
+    abandoned = message.queue()
+    ProfessorMessageDelivery.objects.filter(id=abandoned.id) \
+        .update(status='sending', started_date=timezone.now() - timedelta(hours=2))
+    call_command('send_professor_messages', retry_failed=True)
+    assert ProfessorMessageDelivery.objects.filter(status='sent').count() == 2
+    assert len(mail.outbox) == 2
+
+
+@pytest.mark.django_db
+def test_professor_message_add_recipients():
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.models import Group
+    from conftest import create_user
+    from core.models import ProfessorMessage
+
+    User = get_user_model()
+    group = mommy.make(Group)
+    other_group = mommy.make(Group)
+    users = [create_user('student%d' % i) for i in range(5)]
+    for user in users[:3]:
+        user.groups.add(group, other_group)
+
+    message = mommy.make('ProfessorMessage')
+    message.add_recipients(User.objects.filter(groups__in=[group, other_group]), chunk_size=2)
+    assert set(message.users.all()) == set(users[:3])
+
+    # every user, including the professor made with the message
+    message.add_recipients(User.objects.all(), chunk_size=2)
+    assert message.users.count() == User.objects.count()
+    assert set(User.objects.values_list('unread_messages', flat=True)) == set([1])
+
+    User.objects.filter(id=users[0].id).update(unread_messages=5)
+    assert ProfessorMessage.rebuild_unread_counts() == 1
+    assert User.objects.get(id=users[0].id).unread_messages == 1
@@ -6,6 +6,12 @@ from conftest import create_user
 from core.models import Class, Course
 
 
+def grant_permissions(user, *codenames):
+    """Give a user the model permissions the students group has in initial.json."""
+    from django.contrib.auth.models import Permission
+    user.user_permissions.add(*Permission.objects.filter(codename__in=codenames))
+
+
 @pytest.mark.django_db
 def test_lesson(admin_client):
     lesson = mommy.make('Lesson', slug='lesson', status='published')
@@ -350,3 +356,308 @@ def test_only_admin_or_coordinator_can_edit_courseprofessors(client, admin_clien
     changed_course_professor = CourseProfessor.objects.get(id=course_professor.id)
     assert response.status_code == 200
     assert changed_course_professor.biography == 'Another biography as admin'
+
+
+@pytest.mark.django_db
+def test_student_progress_bulk(client):
+    import json
+    from core.models import CourseStudent, StudentProgress
+
+    student = create_user('student')
+    grant_permissions(student, 'add_studentprogress')
+    course = mommy.make('Course')
+    lesson = mommy.make('Lesson', course=course, status='published')
+    unit1 = mommy.make('Unit', lesson=lesson)
+    unit2 = mommy.make('Unit', lesson=lesson)
+    unit3 = mommy.make('Unit', lesson=lesson)
+    course.enroll_student(student)
+    mommy.make('StudentProgress', user=student, unit=unit1, complete='2017-01-01T10:00:00Z')
+    mommy.make('StudentProgress', user=student, unit=unit2)
+
+    client.login(username=student.username, password='password')
+    events = json.dumps([
+        {'unit': unit1.id, 'is_complete': True, 'timestamp': '2017-02-01T10:00:00Z'},
+        {'unit': unit2.id, 'is_complete': True, 'timestamp': '2017-02-02T10:00:00Z'},
+        {'unit': unit2.id, 'is_complete': True, 'timestamp': '2017-02-01T10:00:00Z'},
+        {'unit': unit3.id},
+        {'unit': 0, 'is_complete': True},
+    ])
+    response = client.post('/api/student_progress/bulk', events,
+                           content_type='application/json;charset=UTF-8')
+
+    assert response.status_code == 200
+    assert len(response.data) == 3
+    progress = dict((p.unit_id, p) for p in StudentProgress.objects.filter(user=student))
+    # the first completion timestamp wins
+    assert progress[unit1.id].complete.month == 1
+    assert progress[unit2.id].complete.day == 1
+    assert progress[unit3.id].complete is None
+    assert CourseStudent.objects.get(user=student, course=course).completed_units == 2
+
+    # a retried batch changes nothing
+    response = client.post('/api/student_progress/bulk', events,
+                           content_type='application/json;charset=UTF-8')
+    assert response.status_code == 200
+    assert StudentProgress.objects.filter(user=student).count() == 3
+    assert CourseStudent.objects.get(user=student, course=course).completed_units == 2
+
+
+@pytest.mark.django_db
+def test_student_progress_access_write_behind(client, settings):
+    from datetime import timedelta
+    from core.models import StudentProgress
+    from core.progress_buffer import get_access_buffer
+
+    settings.STUDENT_PROGRESS_WRITE_BEHIND = 'memory'
+    settings.STUDENT_PROGRESS_FLUSH_INTERVAL = 3600
+    student = create_user('student')
+    grant_permissions(student, 'add_studentprogress')
+    unit = mommy.make('Unit')
+    progress = mommy.make('StudentProgress', user=student, unit=unit)
+    old_access = progress.last_access - timedelta(days=1)
+    StudentProgress.objects.filter(id=progress.id).update(last_access=old_access)
+
+    client.login(username=student.username, password='password')
+    response = client.post('/api/student_progress', {'unit': unit.id})
+    assert response.status_code == 200
+    assert StudentProgress.objects.get(id=progress.id).last_access == old_access
+
+    get_access_buffer().flush()
+    assert StudentProgress.objects.get(id=progress.id).last_access > old_access
+
+    # completions are never buffered
+    response = client.post('/api/student_progress', {'unit': unit.id, 'is_complete': 'True'})
+    assert StudentProgress.objects.get(id=progress.id).complete is not None
+
+
+def test_student_progress_cache_write_behind_needs_shared_cache(settings):
+    from django.core.exceptions import ImproperlyConfigured
+    from core.progress_buffer import CacheAccessBuffer
+
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    with pytest.raises(ImproperlyConfigured):
+        CacheAccessBuffer(30)
+
+
+@pytest.mark.django_db
+def test_student_progress_create_is_idempotent(client):
+    from core.models import CourseStudent, StudentProgress
+
+    student = create_user('student')
+    grant_permissions(student, 'add_studentprogress')
+    course = mommy.make('Course')
+    lesson = mommy.make('Lesson', course=course)
+    unit = mommy.make('Unit', lesson=lesson)
+    course.enroll_student(student)
+
+    client.login(username=student.username, password='password')
+    response = client.post('/api/student_progress', {'unit': unit.id, 'is_complete': 'True'})
+    assert response.status_code == 200
+    complete = StudentProgress.objects.get(user=student, unit=unit).complete
+
+    response = client.post('/api/student_progress', {'unit': unit.id, 'is_complete': 'True'})
+    assert response.status_code == 200
+    response = client.post('/api/student_progress', {'unit': unit.id})
+    assert response.status_code == 200
+
+    progress = StudentProgress.objects.get(user=student, unit=unit)
+    assert progress.complete == complete
+    assert CourseStudent.objects.get(user=student, course=course).completed_units == 1
+
+    assert client.post('/api/student_progress', {}).status_code == 400
+    assert client.post('/api/student_progress', {'unit': 'x'}).status_code == 400
+    assert client.post('/api/student_progress', {'unit': unit.id + 1000}).status_code == 404
+    assert StudentProgress.objects.filter(user=student).count() == 1
+
+
+@pytest.mark.django_db
+def test_note_create_keeps_existing_note(client):
+    from django.contrib.contenttypes.models import ContentType
+    from notes.models import Note
+
+    student = create_user('student')
+    grant_permissions(student, 'add_note')
+    unit = mommy.make('Unit')
+    content_type = ContentType.objects.get_for_model(unit)
+
+    client.login(username=student.username, password='password')
+    data = {'text': 'first', 'content_type': content_type.id, 'object_id': unit.id}
+    response = client.post('/api/note', data)
+    assert response.status_code == 201
+    data['text'] = 'second'
+    response = client.post('/api/note', data)
+    assert response.status_code == 201
+
+    assert Note.objects.filter(user=student).count() == 1
+    assert response.data['text'] == 'first'
+
+
+def _course_with_professors(group):
+    from datetime import date, timedelta
+
+    course = mommy.make('Course', status='published', start_date=date.today() + timedelta(days=1),
+                        intro_video=mommy.make('Video'))
+    course.groups.add(group)
+    for role in ('coordinator', 'assistant'):
+        assign_professor_to_course(course, new_professor_username='%s-%d' % (role, course.id), role=role)
+    mommy.make('CourseAuthor', course=course, user=create_user('author-%d' % course.id))
+    return course
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('url', ['/api/course', '/api/course_carousel'])
+def test_course_list_query_count_does_not_grow_with_courses(client, url):
+    from django.contrib.auth.models import Group
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    group = mommy.make(Group)
+    user = create_user('student')
+    user.groups.add(group)
+    client.login(username=user.username, password='password')
+
+    _course_with_professors(group)
+    with CaptureQueriesContext(connection) as few_courses:
+        response = client.get(url)
+    assert len(response.data) == 1
+
+    for i in range(4):
+        _course_with_professors(group)
+    with CaptureQueriesContext(connection) as many_courses:
+        response = client.get(url)
+    assert len(response.data) == 5
+    assert len(many_courses) == len(few_courses)
+
+
+@pytest.mark.django_db
+def test_reports_user_course_stats_query_count(admin_client):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    course = mommy.make('Course')
+    unit = mommy.make('Unit', lesson=mommy.make('Lesson', course=course))
+
+    def enroll(username):
+        student = create_user(username)
+        course.enroll_student(student)
+        mommy.make('StudentProgress', user=student, unit=unit, complete='2017-01-01T10:00:00Z')
+
+    enroll('student0')
+    with CaptureQueriesContext(connection) as few_students:
+        response = admin_client.get('/api/reports', {'course': course.id})
+    assert len(response.data) == 1
+
+    for i in range(1, 5):
+        enroll('student%d' % i)
+    with CaptureQueriesContext(connection) as many_students:
+        response = admin_client.get('/api/reports', {'course': course.id})
+    assert len(response.data) == 5
+    assert [s['course_progress'] for s in response.data] == [100] * 5
+    assert len(many_students) == len(few_students)
+
+
+@pytest.mark.django_db
+def test_reports_csv_export(admin_client, client, monkeypatch):
+    from reports.views import CourseReportExportView
+
+    course = mommy.make('Course', slug='course')
+    lesson1 = mommy.make('Lesson', course=course, slug='lesson1', position=1, status='published')
+    mommy.make('Lesson', course=course, slug='lesson2', position=2, status='published')
+    unit = mommy.make('Unit', lesson=lesson1)
+    for i in range(3):
+        student = create_user('student%d' % i)
+        course.enroll_student(student)
+    mommy.make('StudentProgress', user=student, unit=unit, complete='2017-01-01T10:00:00Z')
+
+    monkeypatch.setattr(CourseReportExportView, 'chunk_size', 2)
+    response = admin_client.get('/course/course/reports/export/')
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+
+    assert response['Content-Type'].startswith('text/csv')
+    assert lines[0].startswith('user_name,username,email')
+    assert len(lines) == 1 + 3 * 2
+    assert 'student2,student2@example.com,100,' in lines[-2]
+    assert ',lesson1,100,01/01/2017' in lines[-2]
+
+    # students who are not professors of the course get an empty report
+    client.login(username='student0', password='password')
+    response = client.get('/course/course/reports/export/')
+    assert len(b''.join(response.streaming_content).splitlines()) == 1
+
+
+@pytest.mark.django_db
+def test_professor_messages_read_state_and_unread_count(client):
+    student = create_user('student')
+    messages = mommy.make('ProfessorMessage', _quantity=3)
+    for message in messages:
+        message.users.add(student)
+    mommy.make('ProfessorMessageRead', user=student, message=messages[0], is_read=True)
+    mommy.make('ProfessorMessageRead', user=create_user('other'), message=messages[1], is_read=True)
+
+    client.login(username=student.username, password='password')
+    response = client.get('/api/professor_message')
+    assert dict((m['id'], m['is_read']) for m in response.data) == {
+        messages[0].id: True, messages[1].id: False, messages[2].id: False}
+
+    response = client.get('/api/professor_message', {'unread': 'true'})
+    assert set(m['id'] for m in response.data) == set([messages[1].id, messages[2].id])
+
+    response = client.get('/api/professor_message/unread_count')
+    assert response.data == {'unread_count': 2}
+
+    mommy.make('ProfessorMessageRead', user=student, message=messages[1], is_read=True)
+    response = client.get('/api/professor_message/unread_count')
+    assert response.data == {'unread_count': 1}
+
+    # the counter is stored on the user and never overwritten by profile saves
+    student.save()
+    assert client.get('/api/professor_message/unread_count').data == {'unread_count': 1}
+
+    messages[2].users.remove(student)
+    assert client.get('/api/professor_message/unread_count').data == {'unread_count': 0}
+    messages[1].users.add(student)
+    messages[2].users.add(student)
+    assert client.get('/api/professor_message/unread_count').data == {'unread_count': 1}
+    messages[2].delete()
+    assert client.get('/api/professor_message/unread_count').data == {'unread_count': 0}
+
+
+@pytest.mark.django_db
+def test_professor_messages_bulk_mark_as_read(client):
+    import json
+    from core.models import ProfessorMessageRead
+
+    student = create_user('student')
+    messages = mommy.make('ProfessorMessage', _quantity=4)
+    for message in messages[:3]:
+        message.users.add(student)
+    mommy.make('ProfessorMessageRead', user=student, message=messages[0], is_read=False)
+
+    client.login(username=student.username, password='password')
+    assert client.get('/api/professor_message/unread_count').data == {'unread_count': 3}
+
+    response = client.post('/api/professor_message_read/bulk',
+                           json.dumps({'up_to': messages[1].id}),
+                           content_type='application/json;charset=UTF-8')
+    assert response.data == {'marked': 2}
+    assert client.get('/api/professor_message/unread_count').data == {'unread_count': 1}
+
+    # messages not received by the user are ignored
+    response = client.post('/api/professor_message_read/bulk',
+                           json.dumps({'messages': [m.id for m in messages]}),
+                           content_type='application/json;charset=UTF-8')
+    assert response.data == {'marked': 1}
+    assert client.get('/api/professor_message/unread_count').data == {'unread_count': 0}
+    assert ProfessorMessageRead.objects.filter(user=student, is_read=True).count() == 3
+
+    response = client.post('/api/professor_message_read/bulk', json.dumps({}),
+                           content_type='application/json;charset=UTF-8')
+    assert response.status_code == 400
+
+    # marking a single message also updates the counter
+    message = mommy.make('ProfessorMessage')
+    message.users.add(student)
+    assert client.get('/api/professor_message/unread_count').data == {'unread_count': 1}
+    response = client.post('/api/professor_message_read', {'message': message.id})
+    assert response.status_code == 201
+    assert client.get('/api/professor_message/unread_count').data == {'unread_count': 0}
@@ -2,6 +2,7 @@ import os
 import hashlib
 from django.utils.deconstruct import deconstructible
 from django.conf import settings
+from django.db import IntegrityError, connections, models, router, transaction
 from django.core.urlresolvers import reverse_lazy
 from braces.views._access import AccessMixin
 from django.shortcuts import redirect
@@ -34,3 +35,105 @@ class AcceptedTermsRequiredMixin(AccessMixin):
         if not self.request.user.accepted_terms and settings.TERMS_ACCEPTANCE_REQUIRED:
             return redirect(reverse_lazy('accept_terms'))
         return super(AcceptedTermsRequiredMixin, self).dispatch(request, *args, **kwargs)
+
+
+def skip_counter_fields(instance, counter_fields, save_kwargs):
+    """
+    Make a plain save() of an existing row leave the counter_fields alone,
+    so the values loaded with the instance never overwrite the F()
+    increments made since. New rows and explicit update_fields are kept.
+    Returns the save() keyword arguments.
+    """
+    if instance._state.adding or save_kwargs.get('force_insert') or \
+            save_kwargs.get('update_fields') is not None:
+        return save_kwargs
+    save_kwargs['update_fields'] = [field.name for field in instance._meta.concrete_fields
+                                    if not field.primary_key and field.name not in counter_fields]
+    return save_kwargs
+
+
+def supports_upsert(connection):
+    """True when the database has INSERT ... ON CONFLICT (PostgreSQL 9.5+)."""
+    return connection.vendor == 'postgresql' and connection.pg_version >= 90500
+
+
+def upsert(model, conflict_fields, values, update_fields=(), keep_fields=()):
+    """
+    Insert a row or, when a row with the same conflict_fields already
+    exists, update it in a single INSERT ... ON CONFLICT statement, so
+    concurrent requests never race into an IntegrityError.
+
+    values maps field names to the values of the new row (pks for foreign
+    keys). On conflict the update_fields are overwritten with the new
+    values, the keep_fields only when they are still NULL, and every other
+    column is left untouched. conflict_fields must be covered by a unique
+    constraint. Without update_fields and keep_fields an existing row is
+    not written at all. Model signals are not sent.
+
+    Databases without ON CONFLICT support (e.g. SQLite) get an equivalent
+    sequence of queries instead. Returns the stored instance.
+    """
+    opts = model._meta
+    obj = model(**dict((opts.get_field(name).attname, value)
+                       for name, value in values.items()))
+    fields = [f for f in opts.concrete_fields if not isinstance(f, models.AutoField)]
+    # fill defaults and auto_now fields as Model.save() would
+    for field in fields:
+        setattr(obj, field.attname, field.pre_save(obj, True))
+
+    connection = connections[router.db_for_write(model)]
+    if supports_upsert(connection):
+        return _pg_upsert(connection, obj, fields, conflict_fields,
+                          update_fields, keep_fields)
+
+    lookup = dict((name, values[name]) for name in conflict_fields)
+    queryset = model._default_manager.using(connection.alias).filter(**lookup)
+    if not queryset.exists():
+        try:
+            with transaction.atomic(using=connection.alias):
+                queryset.bulk_create([obj])
+            return queryset.get()
+        except IntegrityError:
+            # another request inserted the row first
+            pass
+    if update_fields:
+        queryset.update(**dict((name, getattr(obj, opts.get_field(name).attname))
+                               for name in update_fields))
+    for name in keep_fields:
+        queryset.filter(**{name: None}) \
+            .update(**{name: getattr(obj, opts.get_field(name).attname)})
+    return queryset.get()
+
+
+def _pg_upsert(connection, obj, fields, conflict_fields, update_fields, keep_fields):
+    opts = obj._meta
+    qn = connection.ops.quote_name
+    table = qn(opts.db_table)
+    column = lambda name: qn(opts.get_field(name).column)
+
+    assignments = ['%s = EXCLUDED.%s' % (column(name), column(name))
+                   for name in update_fields]
+    assignments += ['%s = COALESCE(%s.%s, EXCLUDED.%s)' % (column(name), table,
+                                                           column(name), column(name))
+                    for name in keep_fields]
+    # without assignments an existing row is left alone: even a no-op
+    # DO UPDATE would write a new row version
+    action = 'DO UPDATE SET %s' % ', '.join(assignments) if assignments else 'DO NOTHING'
+
+    sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) %s RETURNING %s' % (
+        table,
+        ', '.join(qn(f.column) for f in fields),
+        ', '.join(['%s'] * len(fields)),
+        ', '.join(column(name) for name in conflict_fields),
+        action,
+        ', '.join(qn(f.column) for f in opts.concrete_fields))
+    params = [f.get_db_prep_save(getattr(obj, f.attname), connection) for f in fields]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    if row is None:
+        # DO NOTHING returns no row when it already existed
+        lookup = dict((opts.get_field(name).attname, getattr(obj, opts.get_field(name).attname))
+                      for name in conflict_fields)
+        return opts.model._default_manager.using(connection.alias).get(**lookup)
+    return obj.from_db(connection.alias, [f.attname for f in opts.concrete_fields], row)
@@ -15,8 +15,9 @@ from django.contrib.flatpages.models import FlatPage
 from django.contrib.auth import get_user_model
 from django.shortcuts import get_object_or_404, redirect
 from django.conf import settings
-from django.utils import timezone
 from rest_framework import viewsets, mixins
+from rest_framework.decorators import list_route
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework import filters
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
@@ -29,10 +30,12 @@ from notes.models import Note
 
 from .serializers import (CourseSerializer, CourseProfessorSerializer,
                           CourseThumbSerializer, LessonSerializer,
-                          StudentProgressSerializer, CourseNoteSerializer,
+                          StudentProgressSerializer, StudentProgressEventSerializer,
+                          CourseNoteSerializer,
                           LessonNoteSerializer, ProfessorMessageSerializer,
                           SimpleLessonSerializer,
-                          ProfessorMessageReadSerializer, ProfessorGlobalMessageSerializer,
+                          ProfessorMessageReadSerializer, ProfessorMessageReadBulkSerializer,
+                          ProfessorGlobalMessageSerializer,
                           CourseStudentSerializer, ClassSerializer,
                           ClassActivitySerializer, FlatpageSerializer,
                           CourseAuthorPictureSerializer,
@@ -54,7 +57,8 @@ from .forms import (ContactForm, RemoveStudentForm,
 from .permissions import (IsProfessorCoordinatorOrAdminPermissionOrReadOnly,
                           IsAdminOrReadOnly, IsAssistantOrCoordinatorOrReadOnly)
 
-from .utils import AcceptedTermsRequiredMixin
+from .progress import record_progress, record_progress_events
+from .utils import AcceptedTermsRequiredMixin, upsert
 
 
 class DashboardView(AcceptedTermsRequiredMixin, TemplateView):
@@ -521,15 +525,12 @@ class ProfessorMessageViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         obj = serializer.save(professor=self.request.user)
         if obj:
-            obj.send()
+            obj.queue()
 
     def get_queryset(self):
-        queryset = ProfessorMessage.objects.filter(users__in=[self.request.user]).order_by('-id')
-
+        # Exclude read messages when unread is given
         unread = self.request.query_params.get('unread', None)
-        if unread:
-            # Exclude read messages
-            queryset = queryset.exclude(read_status__is_read=True, read_status__user=self.request.user)
+        queryset = ProfessorMessage.for_user(self.request.user, unread=bool(unread)).order_by('-id')
 
         limit_to = self.request.query_params.get('limit_to', None)
         if limit_to:
@@ -537,6 +538,10 @@ class ProfessorMessageViewSet(viewsets.ModelViewSet):
 
         return queryset
 
+    @list_route()
+    def unread_count(self, request):
+        return Response({'unread_count': ProfessorMessage.unread_count(request.user)})
+
 
 # This view creates ProfessorMessages targeting specific users and with no ties to any course
 # Only site admins can create messages using this endpoint
@@ -565,12 +570,28 @@ class ProfessorMessageReadViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated,)
 
     def perform_create(self, serializer):
-        try:
-            read_info = serializer.save(user=self.request.user, is_read=True)
-        except IntegrityError as e:
-            read_info = ProfessorMessageRead.objects.get(message=self.request.data['message'], user=self.request.user)
-            read_info.is_read = True
-            read_info.save()
+        message = serializer.validated_data['message']
+        # mark_read also decrements the unread counter of the user
+        ProfessorMessageRead.mark_read(self.request.user, message_ids=[message.id])
+        serializer.instance = ProfessorMessageRead.objects \
+            .filter(user=self.request.user, message=message).first()
+        if serializer.instance is None:
+            # not a message the user received, so no counter changes
+            serializer.instance = upsert(ProfessorMessageRead, ('user', 'message'), {
+                'user': self.request.user.id,
+                'message': message.id,
+                'is_read': True,
+            }, update_fields=('is_read',))
+
+    @list_route(methods=['post'])
+    def bulk(self, request):
+        """Mark the given messages, or every message up to an id, as read."""
+        serializer = ProfessorMessageReadBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        marked = ProfessorMessageRead.mark_read(request.user,
+                                                message_ids=serializer.validated_data.get('messages'),
+                                                up_to=serializer.validated_data.get('up_to'))
+        return Response({'marked': marked})
 
     def get_queryset(self):
         queryset = ProfessorMessageRead.objects.filter(user=self.request.user).order_by('-id')
@@ -596,18 +617,18 @@ class CourseViewSet(viewsets.ModelViewSet):
         queryset = super(CourseViewSet, self).get_queryset()
         public_courses = self.request.query_params.get('public_courses', None)
         if public_courses:
-            queryset = queryset.filter(status='published').prefetch_related('professors')
+            queryset = queryset.filter(status='published')
         role = self.request.query_params.get('role', None)
         if not self.request.user.is_superuser:
             if role:
                 queryset = queryset.filter(
                     course_professors__role=role,
                     course_professors__user=self.request.user
-                ).prefetch_related('professors')
+                )
 
             queryset = queryset.filter(groups__in=self.request.user.groups.all())
 
-        return queryset.distinct()
+        return CourseSerializer.setup_eager_loading(queryset.distinct())
 
     def post(self, request, **kwargs):
         course = self.get_object()
@@ -651,6 +672,10 @@ class CarouselCourseView(viewsets.ReadOnlyModelViewSet):
     queryset = Course.objects.exclude(status=Course.STATES[0][0]).filter(start_date__gte=datetime.date.today())
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
+    def get_queryset(self):
+        queryset = super(CarouselCourseView, self).get_queryset()
+        return CourseSerializer.setup_eager_loading(queryset)
+
 
 class LessonDetailView(LoginRequiredMixin, DetailView):
     model = Lesson
@@ -665,12 +690,11 @@ class LessonDetailView(LoginRequiredMixin, DetailView):
         context = super(LessonDetailView, self).get_context_data(**kwargs)
         unit_content_type = ContentType.objects.get_for_model(Unit)
         course = self.object.course
-        lessons = list(course.public_lessons)
-        if len(lessons) > 0 and self.object != lessons[-1]:
-            index = lessons.index(self.object)
+        next_lesson = course.get_outline().next_lesson(self.object.id)
+        if next_lesson:
             context['next_url'] = reverse_lazy('lesson',
                                                args=[course.slug,
-                                                     lessons[index + 1].slug])
+                                                     next_lesson.slug])
         context['unit_content_type_id'] = unit_content_type.id
         try:
             context['rocketchat'] = settings.ROCKET_CHAT
@@ -841,21 +865,38 @@ class StudentProgressViewSet(viewsets.ModelViewSet):
     serializer_class = StudentProgressSerializer
 
     def create(self, request):
-        # Check if there is already an instance for the given unit-user pair
-        student_progress, _ = StudentProgress.objects.get_or_create(
-            user=self.request.user,
-            unit=Unit.objects.get(id=self.request.data['unit']))
+        try:
+            unit_id = int(self.request.data['unit'])
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError({'unit': ['A valid unit id is required.']})
+        # checked here, as not every database enforces the foreign key
+        if not Unit.objects.filter(id=unit_id).exists():
+            raise Http404
 
         # If the unit is flagged as completed by the frontend, the 'complete'
         # field must be updated, unless it was updated before
-        if ('is_complete' in self.request.data.keys() and not
-                student_progress.complete):
-            student_progress.complete = timezone.now()
+        try:
+            student_progress = record_progress(
+                self.request.user, unit_id,
+                'is_complete' in self.request.data.keys())
+        except IntegrityError:
+            # the unit was deleted meanwhile
+            raise Http404
 
-        student_progress.save()
         return Response(
             StudentProgressSerializer(student_progress).data)
 
+    @list_route(methods=['post'])
+    def bulk(self, request):
+        """
+        Record many {unit, is_complete, timestamp} events at once, so the
+        lesson player can queue them while offline.
+        """
+        serializer = StudentProgressEventSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        progress = record_progress_events(request.user, serializer.validated_data)
+        return Response(StudentProgressSerializer(progress, many=True).data)
+
     def get_queryset(self):
         queryset = super(StudentProgressViewSet, self).get_queryset()
         return queryset.filter(user=self.request.user)
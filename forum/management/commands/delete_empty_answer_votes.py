@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from forum.models import AnswerVote
+
+
+class Command(BaseCommand):
+    help = 'Delete the zero-value answer votes created as placeholders when answers were listed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many votes each delete removes')
+
+    def handle(self, *args, **options):
+        deleted = 0
+        while True:
+            ids = list(AnswerVote.objects.filter(value=0).order_by('id')
+                       .values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            AnswerVote.objects.filter(id__in=ids, value=0).delete()
+            deleted += len(ids)
+        self.stdout.write('%d votes deleted' % deleted)
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from forum.models import rebuild_vote_totals
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored vote totals of every forum question and answer'
+
+    def handle(self, *args, **options):
+        changed = rebuild_vote_totals()
+        self.stdout.write('%d vote totals updated' % changed)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_vote_totals(apps, schema_editor):
+    for model_name, vote_model_name, field in (('Question', 'QuestionVote', 'question'),
+                                               ('Answer', 'AnswerVote', 'answer')):
+        model = apps.get_model('forum', model_name)
+        vote_model = apps.get_model('forum', vote_model_name)
+        totals = vote_model.objects.order_by() \
+            .values_list(field) \
+            .annotate(Sum('value'))
+        for pk, total in totals.iterator():
+            if total:
+                model.objects.filter(id=pk).update(vote_total=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0002_auto_20151104_0455'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='vote_total',
+            field=models.IntegerField(default=0, verbose_name='Votes', editable=False),
+        ),
+        migrations.AddField(
+            model_name='answer',
+            name='vote_total',
+            field=models.IntegerField(default=0, verbose_name='Votes', editable=False),
+        ),
+        migrations.RunPython(populate_vote_totals, migrations.RunPython.noop),
+    ]
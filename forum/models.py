@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Sum
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from django.template.defaultfilters import slugify
 from autoslug import AutoSlugField
 from core.models import Course, Lesson
+from core.utils import skip_counter_fields
 from django.conf import settings
 
 
@@ -19,10 +22,13 @@ class Question(models.Model):
     hidden = models.BooleanField(verbose_name=_('Hidden'), default=False)
     hidden_by = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('User'), related_name='hidden_questions', default=None, null=True, blank=True)
     hidden_justification = models.TextField(_('Justification'), default=None, null=True, blank=True)
+    vote_total = models.IntegerField(_('Votes'), default=0, editable=False)
 
     def save(self, **kwargs):
         if not self.id and self.title:
             self.slug = slugify(self.title)
+        # only the vote signals and rebuild_vote_totals write vote_total
+        kwargs = skip_counter_fields(self, ('vote_total',), kwargs)
         super(Question, self).save(**kwargs)
 
     def __unicode__(self):
@@ -30,7 +36,7 @@ class Question(models.Model):
 
     @property
     def count_votes(self):
-        return self.votes.aggregate(models.Sum('value'))['value__sum'] or 0
+        return self.vote_total
 
 
 class Answer(models.Model):
@@ -38,13 +44,19 @@ class Answer(models.Model):
     text = models.TextField(_('Answer'))
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('User'), related_name='forum_answers')
     timestamp = models.DateTimeField(auto_now_add=True, editable=False)
+    vote_total = models.IntegerField(_('Votes'), default=0, editable=False)
 
     def __unicode__(self):
         return self.text
 
+    def save(self, **kwargs):
+        # only the vote signals and rebuild_vote_totals write vote_total
+        kwargs = skip_counter_fields(self, ('vote_total',), kwargs)
+        super(Answer, self).save(**kwargs)
+
     @property
     def count_votes(self):
-        return self.votes.aggregate(models.Sum('value'))['value__sum'] or 0
+        return self.vote_total
 
 
 class Vote(models.Model):
@@ -53,10 +65,21 @@ class Vote(models.Model):
     # Defines vote up or vote down. Vote up:1; Vote down: -1.
     value = models.IntegerField(null=False, blank=False, default=0)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Vote, cls).from_db(db, field_names, values)
+        # remember the stored value to shift the vote total on save
+        if 'value' in field_names:
+            instance._loaded_value = instance.value
+        return instance
+
 
 class QuestionVote(Vote):
     question = models.ForeignKey(Question, related_name='votes', verbose_name=_('Question'))
 
+    def shift_vote_total(self, delta):
+        Question.objects.filter(id=self.question_id).update(vote_total=F('vote_total') + delta)
+
 #     class Meta:
 #         unique_together = ('question', 'user')
 
@@ -64,5 +87,49 @@ class QuestionVote(Vote):
 class AnswerVote(Vote):
     answer = models.ForeignKey(Answer, related_name='votes', verbose_name=_('Answer'))
 
+    def shift_vote_total(self, delta):
+        Answer.objects.filter(id=self.answer_id).update(vote_total=F('vote_total') + delta)
+
 #     class Meta:
 #         unique_together = ('answer', 'user')
+
+
+def vote_saved(sender, instance, **kwargs):
+    """Keep Question.vote_total and Answer.vote_total in sync with the votes."""
+    delta = instance.value - getattr(instance, '_loaded_value', 0)
+    instance._loaded_value = instance.value
+    if delta:
+        instance.shift_vote_total(delta)
+
+
+def vote_deleted(sender, instance, **kwargs):
+    value = getattr(instance, '_loaded_value', instance.value)
+    if value:
+        instance.shift_vote_total(-value)
+
+
+post_save.connect(vote_saved, sender=QuestionVote)
+post_delete.connect(vote_deleted, sender=QuestionVote)
+post_save.connect(vote_saved, sender=AnswerVote)
+post_delete.connect(vote_deleted, sender=AnswerVote)
+
+
+@transaction.atomic
+def rebuild_vote_totals():
+    """
+    Recompute Question.vote_total and Answer.vote_total from the votes.
+
+    Returns the number of questions and answers whose totals had drifted.
+    """
+    changed = 0
+    for model, vote_model, field in ((Question, QuestionVote, 'question'),
+                                     (Answer, AnswerVote, 'answer')):
+        totals = dict(vote_model.objects.order_by()
+                      .values_list(field)
+                      .annotate(Sum('value')))
+        for pk, vote_total in model.objects.values_list('id', 'vote_total').iterator():
+            total = totals.get(pk) or 0
+            if total != vote_total:
+                model.objects.filter(id=pk).update(vote_total=total)
+                changed += 1
+    return changed
@@ -1,10 +1,11 @@
+from django.db import models
 from forum.models import Question, Answer, QuestionVote, AnswerVote
 from rest_framework import serializers
 
 
 class QuestionSerializer(serializers.ModelSerializer):
 
-    votes = serializers.SerializerMethodField('count_votes')
+    votes = serializers.IntegerField(source='vote_total', read_only=True)
     username = serializers.SerializerMethodField()
     timestamp = serializers.DateTimeField(read_only=True)
     hidden_to_user = serializers.SerializerMethodField('is_hidden')
@@ -16,12 +17,6 @@ class QuestionSerializer(serializers.ModelSerializer):
                   'votes', 'timestamp', 'username', 'hidden',
                   'hidden_by', 'hidden_to_user', 'moderator', 'hidden_justification',)
 
-    def count_votes(self, obj):
-        if obj:
-            return obj.count_votes
-        else:
-            return 0
-
     def get_username(self, obj):
         if obj:
             return obj.user.username
@@ -39,9 +34,23 @@ class QuestionSerializer(serializers.ModelSerializer):
         return False
 
 
+class AnswerListSerializer(serializers.ListSerializer):
+    """Loads the votes of the current user for every answer at once."""
+
+    def to_representation(self, data):
+        answers = list(data.all() if isinstance(data, models.Manager) else data)
+        request = self.context.get('request')
+        votes = {}
+        if request and request.user.is_authenticated() and answers:
+            for vote in AnswerVote.objects.filter(user=request.user, answer__in=answers):
+                votes[vote.answer_id] = vote
+        self.child.current_user_votes = votes
+        return super(AnswerListSerializer, self).to_representation(answers)
+
+
 class AnswerSerializer(serializers.ModelSerializer):
 
-    votes = serializers.SerializerMethodField('count_votes')
+    votes = serializers.IntegerField(source='vote_total', read_only=True)
     username = serializers.SerializerMethodField('get_username')
     timestamp = serializers.DateTimeField(read_only=True)
     current_user_vote = serializers.SerializerMethodField('get_current_user_vote')
@@ -49,12 +58,7 @@ class AnswerSerializer(serializers.ModelSerializer):
     class Meta:
         model = Answer
         fields = ('id', 'question', 'text', 'votes', 'timestamp', 'username', 'current_user_vote')
-
-    def count_votes(self, obj):
-        if obj:
-            return obj.count_votes
-        else:
-            return 0
+        list_serializer_class = AnswerListSerializer
 
     def get_username(self, obj):
         if obj:
@@ -63,14 +67,23 @@ class AnswerSerializer(serializers.ModelSerializer):
             return u''
 
     def get_current_user_vote(self, obj):
-        current_user_vote, _ = AnswerVote.objects.get_or_create(user=self.context.get('request').user, answer=obj)
+        user = self.context.get('request').user
+        if hasattr(self, 'current_user_votes'):
+            current_user_vote = self.current_user_votes.get(obj.id)
+        elif user.is_authenticated():
+            current_user_vote = AnswerVote.objects.filter(user=user, answer=obj).first()
+        else:
+            current_user_vote = None
+        if current_user_vote is None:
+            # not saved, the vote is only created when the user votes
+            current_user_vote = AnswerVote(answer=obj, user_id=user.id)
         serializer = AnswerVoteSerializer(instance=current_user_vote, many=False, context=self.context)
         return serializer.data
 
 
 class QuestionVoteSerializer(serializers.ModelSerializer):
 
-    user = serializers.IntegerField(read_only=True)
+    user = serializers.IntegerField(source='user_id', read_only=True)
     timestamp = serializers.DateTimeField(read_only=True)
 
     class Meta:
@@ -80,7 +93,7 @@ class QuestionVoteSerializer(serializers.ModelSerializer):
 
 class AnswerVoteSerializer(serializers.ModelSerializer):
 
-    user = serializers.IntegerField(read_only=True)
+    user = serializers.IntegerField(source='user_id', read_only=True)
     timestamp = serializers.DateTimeField(read_only=True)
 
     class Meta:
@@ -72,10 +72,10 @@ def test_question_view_set(user):
 
     # Test 1: student <user> may see students1 questions (they are from the same class),
     # but not students2 questions (different classes)
-    class1 = mommy.make('Class', course=course1, assistant=professor, students=[student1, user])
-    class2 = mommy.make('Class', course=course1, assistant=professor2, students=[student2])
-    class3 = mommy.make('Class', course=course1, assistant=professor, students=[student3])
-    mommy.make('Class', course=course1, assistant=professor, students=[student4])
+    class1 = mommy.make('Class', course=course1, assistants=[professor], students=[student1, user])
+    class2 = mommy.make('Class', course=course1, assistants=[professor2], students=[student2])
+    class3 = mommy.make('Class', course=course1, assistants=[professor], students=[student3])
+    mommy.make('Class', course=course1, assistants=[professor], students=[student4])
 
     question1 = mommy.make('Question', title='Test Question', slug='df', course=course1, user=student1)
     question2 = mommy.make('Question', title='Test Question', slug='df1', course=course1, user=user)
@@ -158,3 +158,97 @@ def test_question_view_set(user):
     # # this assert test if professor can see hidden question, couse question2 is hidden
     # assert QuestionSerializer(question2).data in response4.data
     # assert QuestionSerializer(question3).data not in response4.data
+
+
+@pytest.mark.django_db
+def test_vote_totals(admin_client):
+    from django.core.management import call_command
+    from forum.models import Question, Answer, QuestionVote
+
+    question = mommy.make('Question', title='Test Question', slug='df')
+    answer = mommy.make('forum.Answer', question=question)
+    vote = mommy.make('QuestionVote', question=question, value=1)
+    mommy.make('QuestionVote', question=question, value=1)
+    mommy.make('AnswerVote', answer=answer, value=-1)
+
+    assert Question.objects.get(id=question.id).vote_total == 2
+    assert Answer.objects.get(id=answer.id).vote_total == -1
+
+    vote = QuestionVote.objects.get(id=vote.id)
+    vote.value = -1
+    vote.save()
+    assert Question.objects.get(id=question.id).vote_total == 0
+
+    vote.delete()
+    assert Question.objects.get(id=question.id).vote_total == 1
+
+    # editing an instance loaded before keeps the votes counted meanwhile
+    question.text = 'edited'
+    question.save()
+    answer.save()
+    assert Question.objects.get(id=question.id).vote_total == 1
+    assert Answer.objects.get(id=answer.id).vote_total == -1
+
+    response = admin_client.get('/api/forum_question/' + str(question.id))
+    assert response.data['votes'] == 1
+
+    # totals changed behind the signals are repaired by the command
+    Question.objects.filter(id=question.id).update(vote_total=10)
+    call_command('rebuild_vote_totals')
+    assert Question.objects.get(id=question.id).vote_total == 1
+    assert Answer.objects.get(id=answer.id).vote_total == -1
+
+
+@pytest.mark.django_db
+def test_answer_list_does_not_create_votes(admin_client, admin_user):
+    import json
+    from django.core.management import call_command
+    from forum.models import Answer, AnswerVote
+
+    question = mommy.make('Question', title='Test Question', slug='df')
+    answers = mommy.make('forum.Answer', question=question, _quantity=3)
+    mommy.make('AnswerVote', answer=answers[0], user=admin_user, value=1)
+
+    response = admin_client.get('/api/forum_answer?question=' + str(question.id))
+    assert response.status_code == 200
+    votes = dict((answer['id'], answer['current_user_vote']['value']) for answer in response.data)
+    assert votes == {answers[0].id: 1, answers[1].id: 0, answers[2].id: 0}
+    assert AnswerVote.objects.count() == 1
+
+    # the first vote on an answer creates the vote
+    response = admin_client.put('/api/answer_vote/' + str(answers[1].id),
+                                json.dumps({'answer': answers[1].id, 'value': -1}),
+                                content_type='application/json;charset=UTF-8')
+    assert response.status_code == 200
+    assert AnswerVote.objects.get(answer=answers[1], user=admin_user).value == -1
+    assert Answer.objects.get(id=answers[1].id).vote_total == -1
+
+    mommy.make('AnswerVote', answer=answers[2], value=0, _quantity=2)
+    call_command('delete_empty_answer_votes')
+    assert AnswerVote.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_question_view_set_keyset_pagination(admin_client):
+    from datetime import timedelta
+    from django.utils import timezone
+    from forum.models import Question
+
+    course = mommy.make('Course')
+    questions = mommy.make('Question', course=course, _quantity=5)
+    now = timezone.now()
+    for age, question in enumerate(questions):
+        Question.objects.filter(id=question.id).update(timestamp=now - timedelta(hours=age))
+
+    # without page_size the whole list is returned
+    response = admin_client.get('/api/forum_question?course=%d' % course.id)
+    assert len(response.data) == 5
+
+    response = admin_client.get('/api/forum_question?course=%d&page_size=2' % course.id)
+    assert [q['id'] for q in response.data['results']] == [questions[0].id, questions[1].id]
+
+    seen = [q['id'] for q in response.data['results']]
+    while response.data['next']:
+        response = admin_client.get(response.data['next'])
+        seen += [q['id'] for q in response.data['results']]
+    assert seen == [question.id for question in questions]
@@ -7,14 +7,15 @@ from django.shortcuts import get_object_or_404
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import FormView
 from django.views.generic.list import ListView
-from core.models import Course, Class
+from core.models import Course
 from forum.models import Question, Answer, QuestionVote, AnswerVote
 from forum.forms import QuestionForm
 from forum.serializers import QuestionSerializer, AnswerSerializer, QuestionVoteSerializer, AnswerVoteSerializer
 from forum.permissions import HideQuestionPermission
 from rest_framework import viewsets
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
 from administration.views import AdminMixin
-import operator
 
 
 class CourseForumView(LoginRequiredMixin, ListView):
@@ -81,11 +82,36 @@ class QuestionCreateView(LoginRequiredMixin, FormView):
             return self.form_invalid(form)
 
 
+class QuestionPagination(CursorPagination):
+    """
+    Keyset pagination of questions, newest first. The questions are only
+    paginated when the page_size parameter is given, otherwise the whole
+    list is returned as before.
+    """
+    ordering = '-timestamp'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return None
+        return min(page_size, self.max_page_size) if page_size > 0 else None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        return super(QuestionPagination, self).paginate_queryset(queryset, request, view)
+
+
 class QuestionViewSet(LoginRequiredMixin, viewsets.ModelViewSet):
 
     model = Question
     queryset = Question.objects.all()
     serializer_class = QuestionSerializer
+    pagination_class = QuestionPagination
     filter_fields = ('course', 'user', 'hidden')
     permission_classes = (HideQuestionPermission,)
 
@@ -98,13 +124,12 @@ class QuestionViewSet(LoginRequiredMixin, viewsets.ModelViewSet):
 
     def get_queryset(self):
         # filter by course
-        queryset = super(QuestionViewSet, self).get_queryset()
+        queryset = super(QuestionViewSet, self).get_queryset().select_related('user')
 
         classes_id = self.request.query_params.getlist('classes')
         if classes_id:
-            classes = Class.objects.filter(id__in=classes_id)
-            queries_list = [Q(user__in=klass.students.all()) for klass in classes.all()]
-            queryset = queryset.filter(reduce(operator.or_, queries_list))
+            # a single join through the class students, instead of one subquery per class
+            queryset = queryset.filter(user__classes__in=classes_id).distinct()
 
         course_id = self.request.query_params.get('course')
 
@@ -117,22 +142,21 @@ class QuestionViewSet(LoginRequiredMixin, viewsets.ModelViewSet):
             role = None
 
         if role and role == 'assistant':
-            classes = Class.objects.filter(assistant=self.request.user)
-            queries_list = [Q(user__in=klass.students.all()) for klass in classes.all()]
-            if queries_list:
-                return queryset.filter(reduce(operator.or_, queries_list))
+            return queryset.filter(user__classes__assistants=self.request.user,
+                                   user__classes__course=course_id).distinct()
         elif (role and role == 'coordinator') or self.request.user.is_superuser:
             return queryset
         # it's not professor in this course
         try:
             klass = self.request.user.classes.get(course=course_id)
-            return queryset.filter(Q(hidden=False) | Q(user=self.request.user)).filter(user__in=klass.students.all())
+            return queryset.filter(Q(hidden=False) | Q(user=self.request.user)).filter(user__classes=klass)
         except ObjectDoesNotExist:
             return queryset.none()
 
 
 class AnswerViewSet(LoginRequiredMixin, viewsets.ModelViewSet):
     model = Answer
+    queryset = Answer.objects.select_related('user')
     serializer_class = AnswerSerializer
     filter_fields = ('question', 'user')
 
@@ -174,6 +198,17 @@ class AnswerVoteViewSet(LoginRequiredMixin, viewsets.ModelViewSet):
             self.kwargs['answer'] = obj.answer
         return super(AnswerVoteViewSet, self).pre_save(obj)
 
+    def update(self, request, *args, **kwargs):
+        # answers are listed with unsaved default votes, so the vote
+        # is created on the first update
+        answer = get_object_or_404(Answer, pk=kwargs['answer'])
+        vote = self.get_queryset().filter(answer=answer).first() or \
+            AnswerVote(user=request.user, answer=answer)
+        serializer = self.get_serializer(vote, data=request.data, partial=kwargs.get('partial', False))
+        serializer.is_valid(raise_exception=True)
+        serializer.save(user=request.user, answer=answer)
+        return Response(serializer.data)
+
     def get_queryset(self):
         user = self.request.user
         return AnswerVote.objects.filter(user=user)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+from django.conf import settings
+
+
+def remove_duplicate_notes(apps, schema_editor):
+    Note = apps.get_model('notes', 'Note')
+    duplicates = Note.objects.order_by() \
+        .values('user', 'content_type', 'object_id') \
+        .annotate(first=Min('id'), count=Count('id')) \
+        .filter(count__gt=1)
+    for duplicate in duplicates:
+        Note.objects.filter(user=duplicate['user'],
+                            content_type=duplicate['content_type'],
+                            object_id=duplicate['object_id']) \
+            .exclude(id=duplicate['first']) \
+            .delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_notes, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='note',
+            unique_together=set([('user', 'content_type', 'object_id')]),
+        ),
+    ]
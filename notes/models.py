@@ -14,3 +14,6 @@ class Note(models.Model):
     content_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey('content_type', 'object_id')
+
+    class Meta:
+        unique_together = (('user', 'content_type', 'object_id'),)
@@ -5,6 +5,7 @@ from django.views.generic.base import TemplateView
 from notes.models import Note
 from notes.serializers import NoteSerializer
 from core.models import Course
+from core.utils import upsert
 from rest_framework import viewsets
 
 
@@ -15,9 +16,13 @@ class NotesViewSet(LoginRequiredMixin, viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         # Only create a new note if there isn't one already for this user in this unit
-        if not Note.objects.filter(object_id=serializer.validated_data['object_id'],
-                                   user=self.request.user).exists():
-            serializer.save(user=self.request.user)
+        data = serializer.validated_data
+        serializer.instance = upsert(Note, ('user', 'content_type', 'object_id'), {
+            'user': self.request.user.id,
+            'content_type': data['content_type'].id,
+            'object_id': data['object_id'],
+            'text': data['text'],
+        })
 
     def perform_update(self, serializer):
         serializer.save(user=self.request.user)
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
+import unicodecsv
 from rest_framework import viewsets
 from rest_framework.response import Response
 from braces.views import LoginRequiredMixin
-from core.models import Course, CourseStudent, Class
+from core.models import Course, CourseStudent, Class, get_course_roles
+from core.progress import LessonProgressCalculator
+from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
-from django.views.generic.base import TemplateView
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.generic.base import TemplateView, View
 from reports.serializer import UserCourseStatsSerializer, CourseStats, LessonUserStats
 
 
@@ -15,7 +20,9 @@ class UserCourseStats(LoginRequiredMixin, viewsets.ReadOnlyModelViewSet):
     filter_fields = ('course',)
 
     def get_queryset(self):
-        queryset = super(UserCourseStats, self).get_queryset()
+        # progress comes from the enrollment counters and pictures from the
+        # thumbnail url cache, so the users are the only relation serialized
+        queryset = super(UserCourseStats, self).get_queryset().select_related('user')
         user = self.request.user
         course_id = self.request.query_params.get('course')
         role = None
@@ -75,6 +82,71 @@ class CourseStatsByLessonViewSet(LoginRequiredMixin, viewsets.ReadOnlyModelViewS
         return Response(serializer.data)
 
 
+class Echo(object):
+    """A file-like object that returns what is written, to stream csv rows."""
+
+    def write(self, value):
+        return value
+
+
+class CourseReportExportView(LoginRequiredMixin, View):
+    """
+    Streams the progress of every student of a course in each lesson as a
+    csv file. Enrollments are read in keyset chunks of chunk_size, so the
+    memory used does not grow with the size of the course.
+    """
+    chunk_size = 500
+    header = ['user_name', 'username', 'email', 'course_progress',
+              'lesson', 'slug', 'lesson_progress', 'finish']
+
+    def get(self, request, course_slug):
+        course = get_object_or_404(Course, slug=course_slug)
+        response = StreamingHttpResponse(self.rows(course, self.get_queryset(course)),
+                                         content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="%s.csv"' % course.slug
+        return response
+
+    def get_queryset(self, course):
+        user = self.request.user
+        queryset = CourseStudent.objects.filter(course=course)
+
+        classes_id = self.request.GET.getlist('classes')
+        classes = Class.objects.filter(course=course)
+        if classes_id:
+            classes = classes.filter(id__in=classes_id)
+        # if user is not coordinator or admin, only show his classes
+        if not (get_course_roles(user).get(course.id) == 'coordinator' or
+                user.is_staff or user.is_superuser):
+            classes = classes.filter(assistants=user)
+        elif not classes_id:
+            return queryset
+        return queryset.filter(user__in=get_user_model().objects.filter(classes__in=classes))
+
+    def rows(self, course, queryset):
+        writer = unicodecsv.writer(Echo(), encoding='utf-8')
+        calculator = LessonProgressCalculator(course)
+        yield writer.writerow(self.header)
+
+        last_id = 0
+        while True:
+            chunk = list(queryset.filter(id__gt=last_id).select_related('user')
+                         .order_by('id')[:self.chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1].id
+            progress = calculator.for_users(cs.user_id for cs in chunk)
+            for cs in chunk:
+                for lesson in progress[cs.user_id]:
+                    finish = lesson['finish']
+                    if finish:
+                        finish = finish.strftime('%d/%m/%Y - %H:%M')
+                    yield writer.writerow([
+                        cs.user.get_full_name(), cs.user.username, cs.user.email,
+                        cs.percent_progress(), lesson['name'], lesson['slug'],
+                        int(lesson['progress']), finish,
+                    ])
+
+
 class GeneralReportsView(LoginRequiredMixin, TemplateView):
     template_name = 'general-reports.html'
 
@@ -281,6 +281,26 @@ TWITTER_ACESS_TOKEN_SECRET = ''
 TWITTER_USER = ''
 
 YOUTUBE_API_KEY = ''
+
+# Seconds the per lesson course stats are cached
+COURSE_STATS_CACHE_TIMEOUT = 60
+# Seconds the course lessons and units navigation index is cached
+COURSE_OUTLINE_CACHE_TIMEOUT = 60 * 60
+# Seconds the user picture thumbnail urls are cached
+PICTURE_THUMB_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Write-behind of StudentProgress.last_access updates: None writes every
+# visit immediately, 'memory' buffers them in each process and 'cache'
+# buffers them in the cache backend (see the flush_progress_access command),
+# which must then be shared by every process (e.g. memcached, not locmem)
+STUDENT_PROGRESS_WRITE_BEHIND = None
+STUDENT_PROGRESS_FLUSH_INTERVAL = 30
+
+# When True, professor messages are only queued by the API and the
+# send_professor_messages command delivers them (run it from cron)
+PROFESSOR_MESSAGE_ASYNC_DELIVERY = False
+# Maximum recipients on the BCC header of each professor message e-mail
+PROFESSOR_MESSAGE_BCC_SIZE = 100
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
@@ -34,7 +34,8 @@ from forum.views import (CourseForumView, QuestionView, QuestionCreateView, Ques
                          QuestionVoteViewSet, AnswerVoteViewSet, AnswerViewSet as ForumAnswerViewSet)
 from course_material.views import CourseMaterialView, FileUploadView, CourseMaterialViewSet, CourseMaterialFileViewSet
 from notes.views import NotesViewSet, CourseNotesView, UserNotesView
-from reports.views import UserCourseStats, CourseStatsByLessonViewSet, UserCourseLessonsStats, GeneralReportsView
+from reports.views import (UserCourseStats, CourseStatsByLessonViewSet, UserCourseLessonsStats, GeneralReportsView,
+                           CourseReportExportView)
 from rest_framework import routers
 from django_markdown import flatpages
 
@@ -163,6 +164,7 @@ urlpatterns = patterns(
 
     # Reports
     url(r'^course/(?P<course_slug>[-a-zA-Z0-9_]+)/reports/$', GenericCourseView.as_view(template_name="administration/stats.html"), name='reports'),
+    url(r'^course/(?P<course_slug>[-a-zA-Z0-9_]+)/reports/export/$', CourseReportExportView.as_view(), name='reports_export'),
 
     url(r'^general-reports/$', permission_required('is_staff')(GeneralReportsView.as_view()), name='general_reports'),
 